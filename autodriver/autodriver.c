@@ -42,8 +42,11 @@
 // How autodriver works:
 //
 // The parent process creates an output file and starts a child process run_job().
-// The child process assumes under the home directory of the user "autograde"
-// there is a directory specified on the command line of this program.
+// The child process assumes under the home directory of the grading user
+// ("autograde" unless -g is given) there is a directory specified on the
+// command line of this program.  Jobs graded at the same time on one machine
+// need different grading users, because everything the grading user owns is
+// killed and deleted after the job.
 // Under that directory, there is a Makefile.
 // The child will run the Makefile to start the tests and redirects all output
 // to the output file created by the parent process.
@@ -93,7 +96,7 @@ char * getTimestamp(time_t t) {
 /* Name of file to redirect output to */
 #define OUTPUT_FILE     "output.log"
 
-/* User to grade as */
+/* Default user to grade as */
 #define GRADING_USER    "autograde"
 
 /* Size of buffers */
@@ -116,6 +119,7 @@ struct arguments {
     struct passwd user_info;
     char *passwd_buf;
     char *directory;
+    char *grading_user;
     char *timezone;
     unsigned timestamp_interval;
 } args;
@@ -450,6 +454,9 @@ static error_t parse_opt(int key, char *arg, struct argp_state *state) {
     case 'z':
         args.timezone = arg;
         break;
+    case 'g':
+        args.grading_user = arg;
+        break;
     case ARGP_KEY_ARG:
         switch (state->arg_num) {
         case 0:
@@ -511,6 +518,13 @@ static void setup_dir(void) {
         exit(EXIT_OSERROR);
     }
 
+    // The directory may have been given as a path.  From now on it's
+    // right under the home directory
+    char *base = strrchr(args.directory, '/');
+    if (base && base[1]) {
+        args.directory = base + 1;
+    }
+
     // And switch over to that directory
     if (chdir(args.user_info.pw_dir) < 0) {
         ERROR_ERRNO("Changing directories");
@@ -576,7 +590,7 @@ static void dump_output(void) {
 static int kill_processes(char *sig) {
     int ret;
     char *pkill_args[] = {"/usr/bin/pkill", sig, "-u",
-        GRADING_USER, NULL};
+        args.user_info.pw_name, NULL};
 
     if ((ret = call_program("/usr/bin/pkill", pkill_args)) > 1) {
         ERROR("Killing user processes");
@@ -777,6 +791,7 @@ int main(int argc, char **argv) {
     args.osize = 0;
     args.timestamp_interval = 0;
     args.timezone = NULL;
+    args.grading_user = GRADING_USER;
     startTime = time(NULL);
 
     // Make sure this isn't being run as root
@@ -785,16 +800,6 @@ int main(int argc, char **argv) {
         exit(EXIT_USAGE);
     }
 
-    // Pull info for grading user
-    if (parse_user(GRADING_USER, &args.user_info, &args.passwd_buf) < 0) {
-        ERROR("Invalid grading user");
-        exit(EXIT_OSERROR);
-    }
-    if (args.user_info.pw_uid == getuid()) {
-        ERROR("This should not be run as the grading user " GRADING_USER);
-        exit(EXIT_USAGE);
-    }
-
     struct argp_option options[] = {
         {"nproc", 'u', "number", 0, 
             "Limit the number of processes the user is allowed", 0},
@@ -808,6 +813,8 @@ int main(int argc, char **argv) {
             "Interval (seconds) for placing timestamps in user output file", 0},
         {"timezone", 'z', "timezone", 0,
             "Timezone setting. Default is UTC", 0},
+        {"user", 'g', "user", 0,
+            "User to grade as. Default is " GRADING_USER, 0},
         {0, 0, 0, 0, 0, 0}
     };
 
@@ -816,6 +823,20 @@ int main(int argc, char **argv) {
 
     argp_parse(&parser, argc, argv, 0, NULL, &args);
 
+    // Pull info for grading user
+    if (parse_user(args.grading_user, &args.user_info, &args.passwd_buf) < 0) {
+        ERROR("Invalid grading user %s", args.grading_user);
+        exit(EXIT_OSERROR);
+    }
+    if (args.user_info.pw_uid == getuid()) {
+        ERROR("This should not be run as the grading user %s", args.grading_user);
+        exit(EXIT_USAGE);
+    }
+    if (args.user_info.pw_uid == 0) {
+        ERROR("The grading user can't be root");
+        exit(EXIT_USAGE);
+    }
+
     // set time zone preference: -z argument, TZ environment variable, system wide
     if (args.timezone) {
       char tz[100];
@@ -0,0 +1,405 @@
+# bench.py: Benchmark the Grader offline.  Copies of a job go through the
+# grading service (grader.py --serve) against a simulated EC2, whose vms
+# are all one local ssh host, e.g. a container made from
+# autodriver/Dockerfile.  No AWS account is needed.
+#
+# Reports jobs/minute, the percentiles of the job and phase times from the
+# jobs' metrics.json and the EC2 API calls per job.
+
+# *** read README.md for details. ***
+
+import os
+import time
+import types
+import json
+import random
+import shutil
+import fnmatch
+import tempfile
+import argparse
+import threading
+import collections
+from datetime import datetime, timezone
+
+import yaml
+from botocore.exceptions import ClientError
+
+import grader
+
+# Simulated EC2: the client calls the Grader makes, with
+# latency, throttling, launch failures, instances stuck in pending and
+# instances which never answer ssh.  Instances move through their states
+# by the clock, see state().
+class FakeEc2():
+    _IMAGE_ID = "ami-bench"
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()   # operation -> calls
+        self.faults = collections.Counter()  # error code -> simulated errors
+        self.instances = {}  # id -> {"running": time, "terminated": time or None, ...}
+        self.groups = {}     # id -> name
+        self.count = 0
+        # EC2's own request token bucket, see --api-limit
+        self.tokens = args.api_burst
+        self.tokensTime = time.time()
+
+    # Every API call: count it, take the simulated latency, maybe throttle,
+    # at random or when the account's calls exceed --api-limit
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+            overLimit = False
+            if self.args.api_limit > 0:
+                now = time.time()
+                self.tokens = min(self.args.api_burst,
+                                  self.tokens + (now - self.tokensTime) * self.args.api_limit)
+                self.tokensTime = now
+                overLimit = self.tokens < 1
+                if not overLimit:
+                    self.tokens -= 1
+        time.sleep(self.args.api_latency * random.uniform(0.5, 1.5))
+        if overLimit or random.random() < self.args.throttle_rate:
+            self.fail(operation, "RequestLimitExceeded")
+
+    def fail(self, operation, code):
+        with self.lock:
+            self.faults[code] += 1
+        raise ClientError({"Error": {"Code": code, "Message": "simulated by bench.py"}},
+                          operation)
+
+    def newId(self, prefix):
+        with self.lock:
+            self.count += 1
+            return "%s-%08x" % (prefix, self.count)
+
+    def state(self, instance, now):
+        if instance["terminated"] is not None:
+            return "terminated" if now >= instance["terminated"] else "shutting-down"
+        return "running" if now >= instance["running"] else "pending"
+
+    def describe(self, instanceId, now):
+        instance = self.instances[instanceId]
+        state = self.state(instance, now)
+        return {"InstanceId": instanceId,
+                "InstanceType": instance["type"],
+                "State": {"Name": state},
+                "PublicIpAddress": instance["ip"] if state == "running" else None,
+                "PublicDnsName": "",
+                "LaunchTime": datetime.fromtimestamp(instance["launch"], timezone.utc),
+                "Tags": [{"Key": k, "Value": v} for k, v in instance["tags"].items()]}
+
+    # client calls
+
+    def describe_images(self, Owners=None, Filters=None):
+        self.call("DescribeImages")
+        return {"Images": [{"ImageId": self._IMAGE_ID, "CreationDate": "2020-01-01T00:00:00Z"}]}
+
+    def create_security_group(self, GroupName, Description):
+        self.call("CreateSecurityGroup")
+        with self.lock:
+            if GroupName in self.groups.values():
+                duplicate = True
+            else:
+                duplicate = False
+                groupId = "sg-%08x" % (len(self.groups) + 1)
+                self.groups[groupId] = GroupName
+        if duplicate:
+            self.fail("CreateSecurityGroup", "InvalidGroup.Duplicate")
+        return {"GroupId": groupId}
+
+    def authorize_security_group_ingress(self, **kwargs):
+        self.call("AuthorizeSecurityGroupIngress")
+        return {}
+
+    def describe_security_groups(self, Filters=()):
+        self.call("DescribeSecurityGroups")
+        patterns = [v for f in Filters if f["Name"] == "group-name" for v in f["Values"]]
+        with self.lock:
+            return {"SecurityGroups": [{"GroupId": i, "GroupName": n}
+                                       for i, n in self.groups.items()
+                                       if any(fnmatch.fnmatch(n, p) for p in patterns)]}
+
+    def delete_security_group(self, GroupId):
+        self.call("DeleteSecurityGroup")
+        now = time.time()
+        with self.lock:
+            if GroupId not in self.groups:
+                code = "InvalidGroup.NotFound"
+            elif any(GroupId in i["groups"] and self.state(i, now) != "terminated"
+                     for i in self.instances.values()):
+                code = "DependencyViolation"
+            else:
+                code = None
+                del self.groups[GroupId]
+        if code:
+            self.fail("DeleteSecurityGroup", code)
+
+    def describe_instances(self, InstanceIds=None, Filters=()):
+        self.call("DescribeInstances")
+        now = time.time()
+        with self.lock:
+            ids = list(self.instances) if InstanceIds is None else InstanceIds
+            missing = [i for i in ids if i not in self.instances]
+            descriptions = [self.describe(i, now) for i in ids if i in self.instances]
+        if missing:
+            self.fail("DescribeInstances", "InvalidInstanceID.NotFound")
+        for f in Filters:
+            if f["Name"] == "instance-state-name":
+                descriptions = [d for d in descriptions if d["State"]["Name"] in f["Values"]]
+            elif f["Name"].startswith("tag:"):
+                key = f["Name"][len("tag:"):]
+                descriptions = [d for d in descriptions
+                                if any(t["Key"] == key and fnmatch.fnmatch(t["Value"], p)
+                                       for t in d["Tags"] for p in f["Values"])]
+        return {"Reservations": [{"Instances": descriptions}]}
+
+    def terminate_instances(self, InstanceIds):
+        self.call("TerminateInstances")
+        now = time.time()
+        with self.lock:
+            missing = [i for i in InstanceIds if i not in self.instances]
+            for i in InstanceIds:
+                if i in self.instances and self.instances[i]["terminated"] is None:
+                    self.instances[i]["terminated"] = now + self.args.terminate_delay
+        if missing:
+            self.fail("TerminateInstances", "InvalidInstanceID.NotFound")
+        return {"TerminatingInstances": []}
+
+    def describe_instance_types(self, InstanceTypes):
+        self.call("DescribeInstanceTypes")
+        return {"InstanceTypes": [{"InstanceType": t,
+                                   "VCpuInfo": {"DefaultVCpus": self.args.vcpus},
+                                   "MemoryInfo": {"SizeInMiB": self.args.memory_mb}}
+                                  for t in InstanceTypes]}
+
+    def create_tags(self, Resources, Tags):
+        self.call("CreateTags")
+        with self.lock:
+            for r in Resources:
+                if r in self.instances:
+                    self.instances[r]["tags"].update((t["Key"], t["Value"]) for t in Tags)
+
+    def delete_tags(self, Resources, Tags):
+        self.call("DeleteTags")
+        with self.lock:
+            for r in Resources:
+                if r in self.instances:
+                    for t in Tags:
+                        self.instances[r]["tags"].pop(t["Key"], None)
+
+    def get_paginator(self, operation):
+        return types.SimpleNamespace(paginate=lambda **kwargs: [getattr(self, operation)(**kwargs)])
+
+    def run_instances(self, ImageId, InstanceType, KeyName, MaxCount, MinCount,
+                      SecurityGroups=(), SecurityGroupIds=(), SubnetId=None,
+                      TagSpecifications=()):
+        self.call("RunInstances")
+        if ImageId != self._IMAGE_ID:
+            self.fail("RunInstances", "InvalidAMIID.NotFound")
+        if random.random() < self.args.launch_failure_rate:
+            self.fail("RunInstances", "InsufficientInstanceCapacity")
+        with self.lock:
+            groups = set(SecurityGroupIds) | set(i for i, n in self.groups.items()
+                                                 if n in SecurityGroups)
+        if not groups:
+            self.fail("RunInstances", "InvalidGroup.NotFound")
+
+        now = time.time()
+        instanceId = self.newId("i")
+        stuck = random.random() < self.args.stuck_rate
+        dead = random.random() < self.args.dead_rate
+        with self.lock:
+            self.instances[instanceId] = {
+                "type": InstanceType,
+                "launch": now,
+                "running": float("inf") if stuck else
+                           now + self.args.launch_delay * random.uniform(0.5, 1.5),
+                "terminated": None,
+                # TEST-NET-1: nothing answers there
+                "ip": "192.0.2.1" if dead else self.args.host,
+                "groups": groups,
+                "tags": {t["Key"]: t["Value"] for s in TagSpecifications for t in s["Tags"]}}
+        return {"ReservationId": self.newId("r"), "Instances": [{"InstanceId": instanceId}]}
+# end of class FakeEc2
+
+# Stands in for the boto3 module in grader.py
+class FakeBoto3():
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+    def client(self, *args, **kwargs):
+        return self.ec2
+
+# Put args.jobs copies of the job into the spool's incoming/, each with a
+# SUBMISSION_ID of its own, and the service's config.yaml into the spool
+def makeSpool(args, spool):
+    with open(args.config, "r") as f:
+        serviceConfig = yaml.safe_load(f) or {}
+    serviceConfig["SERVICE_CONCURRENCY"] = args.concurrency
+    # keep the simulated image and launch times away from the real ones
+    serviceConfig["IMAGE_CACHE_FILE"] = os.path.join(spool, "image-cache.json")
+    serviceConfig["HEDGE_HISTORY_FILE"] = os.path.join(spool, "launch-history.json")
+    os.makedirs(os.path.join(spool, "incoming"))
+    with open(os.path.join(spool, "config.yaml"), "w") as f:
+        yaml.safe_dump(serviceConfig, f)
+
+    with open(os.path.join(args.job, "config.yaml"), "r") as f:
+        jobConfig = yaml.safe_load(f) or {}
+    submission = jobConfig.get("SUBMISSION_ID", "bench")
+    # made in a staging directory so that the service sees whole jobs only
+    staging = os.path.join(spool, "staging")
+    for n in range(args.jobs):
+        name = "job-%05d" % n
+        shutil.copytree(args.job, os.path.join(staging, name))
+        jobConfig["SUBMISSION_ID"] = "%s-%05d" % (submission, n)
+        with open(os.path.join(staging, name, "config.yaml"), "w") as f:
+            yaml.safe_dump(jobConfig, f)
+    for name in sorted(os.listdir(staging)):
+        os.rename(os.path.join(staging, name), os.path.join(spool, "incoming", name))
+    os.rmdir(staging)
+
+def report(args, spool, ec2, seconds):
+    done = os.path.join(spool, "done")
+    records = []
+    for name in sorted(os.listdir(done)):
+        try:
+            with open(os.path.join(done, name, "metrics.json"), "r") as f:
+                records.append(json.load(f))
+        except (OSError, ValueError):
+            pass  # the job ended before writing its metrics
+    succeeded = len([r for r in records if r["success"]])
+
+    def quantiles(values):
+        values = sorted(values)
+        return {str(q): grader.MetricsReport.percentile(values, q)
+                for q in grader.MetricsReport.QUANTILES} if values else {}
+
+    phases = collections.OrderedDict()
+    for r in records:
+        for name, phase in sorted(r["phases"].items(), key=lambda p: p[1]["start"]):
+            phases.setdefault(name, []).append(phase["seconds"])
+    calls = sum(ec2.calls.values())
+    api = [r["api"] for r in records if r.get("api")]
+    return {"jobs": args.jobs,
+            "succeeded": succeeded,
+            "failed": args.jobs - succeeded,
+            "concurrency": args.concurrency,
+            "seconds": seconds,
+            "jobs_per_minute": args.jobs * 60.0 / seconds,
+            # jobs which ended before writing metrics.json have no times
+            "timed_jobs": len(records),
+            "job_seconds": quantiles([r["seconds"] for r in records]),
+            "phase_seconds": {name: dict(quantiles(v), count=len(v))
+                              for name, v in phases.items()},
+            "api_calls": calls,
+            "api_calls_per_job": calls / args.jobs,
+            "api_calls_per_job_by_operation": {op: n / args.jobs
+                                               for op, n in sorted(ec2.calls.items())},
+            "api_throttles": sum(a["throttles"] for a in api),
+            "api_wait_seconds": dict(quantiles([a["wait_seconds"] for a in api]), count=len(api))
+                                if api else {},
+            "simulated_errors": dict(ec2.faults)}
+
+def printReport(r):
+    print("%d jobs (%d succeeded, %d failed) in %.1fs with concurrency %d: %.2f jobs/minute" %
+          (r["jobs"], r["succeeded"], r["failed"], r["seconds"], r["concurrency"],
+           r["jobs_per_minute"]))
+    header = "  ".join("%8s" % ("p%g" % (q * 100)) for q in grader.MetricsReport.QUANTILES)
+    print("\n%-14s %6s  %s" % ("seconds", "count", header))
+
+    def line(name, count, q):
+        print("%-14s %6d  %s" % (name, count, "  ".join("%8.2f" % q[str(p)] for p in
+                                                      grader.MetricsReport.QUANTILES)))
+    if r["job_seconds"]:
+        line("job", r["timed_jobs"], r["job_seconds"])
+    for name, q in r["phase_seconds"].items():
+        line(name, q["count"], q)
+    print("\nEC2 API calls per job: %.2f" % r["api_calls_per_job"])
+    for op, n in r["api_calls_per_job_by_operation"].items():
+        print("  %-30s %6.2f" % (op, n))
+    if r["api_wait_seconds"]:
+        print("throttled calls seen by the jobs: %d" % r["api_throttles"])
+        line("api wait", r["api_wait_seconds"]["count"], r["api_wait_seconds"])
+    if r["simulated_errors"]:
+        print("simulated errors: %s" % ", ".join("%s %d" % e for e in
+                                                 sorted(r["simulated_errors"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Grader against a simulated EC2 and a local ssh host")
+    parser.add_argument("--config", required=True,
+                        help="config.yaml of the grading service, with the ssh settings "
+                             "of the host")
+    parser.add_argument("--job", required=True,
+                        help="job directory (config.yaml and input files) to grade repeatedly")
+    parser.add_argument("--jobs", type=int, default=20, help="number of jobs")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="jobs graded at the same time (SERVICE_CONCURRENCY)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address of the ssh host standing in for every vm")
+    parser.add_argument("--api-latency", type=float, default=0.05,
+                        help="mean seconds per EC2 API call")
+    parser.add_argument("--launch-delay", type=float, default=10,
+                        help="mean seconds an instance is pending")
+    parser.add_argument("--terminate-delay", type=float, default=5,
+                        help="seconds an instance is shutting down")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="share of API calls failing with RequestLimitExceeded")
+    parser.add_argument("--api-limit", type=float, default=0,
+                        help="API calls per second of the account before EC2 throttles "
+                             "(0 for no limit)")
+    parser.add_argument("--api-burst", type=float, default=50,
+                        help="API calls above --api-limit allowed in a burst")
+    parser.add_argument("--launch-failure-rate", type=float, default=0,
+                        help="share of launches failing with InsufficientInstanceCapacity")
+    parser.add_argument("--stuck-rate", type=float, default=0,
+                        help="share of instances which stay pending")
+    parser.add_argument("--dead-rate", type=float, default=0,
+                        help="share of instances which never answer ssh")
+    parser.add_argument("--vcpus", type=int, default=2,
+                        help="vcpus of every instance type, for PACK_INST_TYPE")
+    parser.add_argument("--memory-mb", type=int, default=4096,
+                        help="MiB of every instance type, for PACK_INST_TYPE")
+    parser.add_argument("--work-dir",
+                        help="directory for the spool, kept after the run (default: a "
+                             "temporary directory, removed)")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as json to FILE")
+    args = parser.parse_args()
+
+    args.config = os.path.abspath(args.config)
+    args.job = os.path.abspath(args.job)
+    work = os.path.abspath(args.work_dir) if args.work_dir else \
+        tempfile.mkdtemp(prefix="grader-bench-")
+    spool = os.path.join(work, "spool")
+    # grader.py reads config_defaults.yaml from the current directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    makeSpool(args, spool)
+    ec2 = FakeEc2(args)
+    grader.boto3 = FakeBoto3(ec2)
+
+    start = time.time()
+    service = grader.GradingService(spool)
+    server = threading.Thread(target=service.serve, name="service", daemon=True)
+    server.start()
+    done = os.path.join(spool, "done")
+    while len(os.listdir(done)) < args.jobs and server.is_alive():
+        time.sleep(0.2)
+    seconds = time.time() - start
+    service.stopping = True
+    server.join()
+
+    r = report(args, spool, ec2, seconds)
+    printReport(r)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(r, f, indent=1)
+    if args.work_dir:
+        print("\nlogs and jobs are in %s" % spool)
+    else:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -18,26 +18,77 @@ from datetime import datetime
 import types
 import yaml
 import atexit
+import json
+import signal
+import argparse
+import threading
+import random
+import socket
+import tarfile
+import hashlib
+import shlex
+import math
+import codecs
+import fcntl
+import collections
 
 import boto3
 from botocore.exceptions import ClientError
 
-# global config.  See config_defaults.yaml for attributes.
+# Config of this process: the single job's, the vm pool manager's or the
+# grading service's.  Each job keeps its own in Grader.config.  See
+# config_defaults.yaml for attributes.
 config = None
 
-# cloud specific obj of class Ec2. make it global for cross-object reference.
-cloudConnector = None
-
-# vm of class VM.  make it global for cross-object reference.
-vm = None
-secGroup = None
-secGroupID = None
+# config attributes only a grading job needs.  A vm pool manager or a
+# grading service can leave them out.
+_JOB_ONLY_CONFIG = ("inputFiles", "SUBMISSION_ID", "SUBMISSION_FILENAME")
+
+# Read config_defaults.yaml, then the given yaml files and
+# <passedInDir>/config.yaml, each overriding the previous ones.  Return
+# the config in dot form, such as config.IMAGE_TAG, and the errors found.
+def loadConfig(passedInDir=None, baseFiles=(), forJob=True):
+    error = []
+
+    with open('config_defaults.yaml', 'r') as f:
+        defaults = yaml.load(f, Loader=yaml.FullLoader)
+    if passedInDir is None:
+        passedInDir = defaults['passedInDir']
+    for path in list(baseFiles) + [os.path.join(passedInDir, 'config.yaml')]:
+        with open(path, 'r') as f:
+            defaults.update(yaml.load(f, Loader=yaml.FullLoader) or {})
+    defaults['passedInDir'] = passedInDir
+
+    # all config must be there
+    for key in defaults:
+        if not forJob and key in _JOB_ONLY_CONFIG:
+            continue
+        if defaults[key] is None:
+            error.append("config %s is missing" % key)
+            break
+
+    # some size config are like "1024*1024".  eval here
+    for a in defaults:
+        if a.endswith('_SIZE') and isinstance(defaults[a], str):
+            defaults[a] = int(eval(defaults[a]))
+
+    cfg = types.SimpleNamespace(**defaults)
+
+    # course number as image tag can be read as a number. convert to str
+    cfg.IMAGE_TAG = str(cfg.IMAGE_TAG)
+    return cfg, error
+
+# Graders with a job in progress, whose vms the exit handler destroys
+activeGraders = set()
+activeGradersLock = threading.Lock()
 
 # exit and exception final handler.
 # last opportunity to destroy the vm.
 def exitHandler():
-    if cloudConnector:
-        cloudConnector.destroyVM(notes="destroyVM initiated from exit handler")
+    with activeGradersLock:
+        graders = list(activeGraders)
+    for grader in graders:
+        grader.destroyVM(notes="destroyVM initiated from exit handler")
 
 class VM():
     def __init__(self, image_tag=None, instance_type=None, name=None):
@@ -45,10 +96,19 @@ class VM():
         self.name = name
         self.instance_type = instance_type
         self.public_ip = None
-        self.image = None
         self.image_id = None
         self.instance = None
         self.instance_id = None
+        # [(from state, to state, seconds)] seen while launching
+        self.state_transitions = []
+        # launched into this subnet instead of the default one, see hedgedLaunch()
+        self.subnet_id = None
+        # ping/ssh readiness times, see Grader.probeVM()
+        self.probe_times = {}
+        # no longer wanted by the job, e.g. the loser of a hedged launch
+        self.dropped = False
+        # Ec2.destroyVM() has been called for it
+        self.destroyed = False
 
     def configStr(self):
         return "VM(name: %s, tag: %s, type: %s)" % (self.name, self.image_tag, self.instance_type)
@@ -57,203 +117,1196 @@ class VM():
         return "VM(id: %s, ip: %s)" % (self.instance_id, self.public_ip)
 # end of class VM
 
-# the cloud dependent module
-class Ec2():
-    def __init__(self):
-        self.image = None
-        images = []
+# sha256 of a file's content, remembered by (path, size, mtime) so that
+# a long running process hashes unchanged files only once.  Only the
+# latest _FILE_HASHES_SIZE files are remembered.
+_FILE_HASHES_SIZE = 10000
+_fileHashes = collections.OrderedDict()
+_fileHashesLock = threading.Lock()
+
+def fileHash(path):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _fileHashesLock:
+        if key in _fileHashes:
+            _fileHashes.move_to_end(key)
+            return _fileHashes[key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    with _fileHashesLock:
+        _fileHashes[key] = h.hexdigest()
+        while len(_fileHashes) > _FILE_HASHES_SIZE:
+            _fileHashes.popitem(last=False)
+    return h.hexdigest()
+
+# File-like object passing writes to another one and counting the bytes
+class ByteCounter():
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.count = 0
+        self.error = None
+
+    def write(self, data):
+        self.dest.write(data)
+        self.count += len(data)
+        return len(data)
+
+    # copy all of src, e.g. a pipe, in chunks.  Keep the error if any.
+    def copyFrom(self, src):
+        try:
+            while True:
+                chunk = src.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+        except (OSError, ValueError) as e:
+            self.error = e
+# end of class ByteCounter
+
+# The job's output file, assembled in a hidden .part file next to it and
+# renamed into place by finish(), so that no one sees a half-written
+# output.  The grader's messages go through one buffered handle, and the
+# vm's output is streamed in as bytes with only invalid UTF-8 escaped (as
+# \xNN).  The file is cut at maxSize bytes.
+class OutputAssembler():
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.partPath = os.path.join(os.path.dirname(path), ".%s.part" % os.path.basename(path))
+        self.maxSize = maxSize
+        self.lock = threading.Lock()  # phases running at the same time write messages
+        self.file = None
+        self.size = 0
+        self.finished = False
+
+    def write(self, data):
+        with self.lock:
+            if self.finished:
+                # late messages, e.g. of an exception after the job, go straight in
+                with open(self.path, "ab") as f:
+                    f.write(data)
+                return
+            if self.file is None:
+                self.file = open(self.partPath, "wb")
+            self.file.write(data)
+            self.size += len(data)
+
+    def message(self, text):
+        self.write(text.encode("utf-8", "backslashreplace"))
+
+    # Write as much of data as fits under maxSize, without splitting a
+    # character.  Return False if data didn't fit.
+    def put(self, data):
+        room = self.maxSize - self.size
+        if len(data) <= room:
+            self.write(data)
+            return True
+        cut = max(room, 0)
+        while cut > 0 and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        self.write(data[:cut])
+        return False
+
+    # Append the file at path.  Valid UTF-8 is only checked, not decoded
+    # and encoded again.  A character split between chunks waits for the
+    # next chunk.  Return False if the file was cut at maxSize.
+    def append(self, path):
+        pending = b""
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                data, pending = pending + chunk, b""
+                while data:
+                    try:
+                        consumed = codecs.utf_8_decode(data, "strict", not chunk)[1]
+                    except UnicodeDecodeError as e:
+                        bad = data[e.start:e.end].decode("utf-8", "backslashreplace").encode()
+                        if not (self.put(data[:e.start]) and self.put(bad)):
+                            return False
+                        data = data[e.end:]
+                        continue
+                    if not self.put(data[:consumed]):
+                        return False
+                    data, pending = b"", data[consumed:]
+                if not chunk:
+                    return True
+
+    # Put the file in place.  Safe to call more than once.
+    def finish(self):
+        with self.lock:
+            if self.finished:
+                return
+            if self.file is None:
+                self.file = open(self.partPath, "wb")
+            self.file.close()
+            os.chmod(self.partPath, 0o644)
+            os.replace(self.partPath, self.path)
+            self.finished = True
+# end of class OutputAssembler
+
+# Timing profile of a job from the markers autodriver puts into its output
+# (see insertTimestamp() in autodriver.c): every AUTODRIVER_TIMESTAMP_INTERVAL
+# seconds or so, the time and how far the output had got.  The output
+# between two markers took the time between them, so the slowest segments
+# show which tests the time went to, and a long one a stall.
+class TimingProfile():
+    _MARKER = re.compile(rb"\.\.\.\[timestamp (\d{8}-\d\d:\d\d:\d\d) inserted by autodriver "
+                         rb"at offset ~(\d+)\.")
+    _START = re.compile(rb"Autodriver@(\d{8}-\d\d:\d\d:\d\d): Test Starts")
+    _END = re.compile(rb"Autodriver@\S+: Test terminates\. Duration: (\d+) seconds")
+    _MESSAGE = b"Autodriver@"
+    _TIME_FORMAT = "%Y%m%d-%H:%M:%S"
+    _LINE_SIZE = 80  # of the output line naming a segment
+    _SLOWEST = 5
+
+    # Return the profile of the output file at path, or None if it has no
+    # start and markers.  With strip, the markers are taken out of the file.
+    @classmethod
+    def extract(cls, path, strip, stallSeconds):
+        start = duration = None
+        points = []  # [seconds since start, output offset]
+        segments = []
+        lastLine = ""
+        kept = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) \
+            if strip else None
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    marker = cls._MARKER.match(line) if start else None
+                    end = cls._END.match(line) if start else None
+                    if marker:
+                        t = (datetime.strptime(marker.group(1).decode(), cls._TIME_FORMAT) -
+                             start).total_seconds()
+                        offset = int(marker.group(2))
+                        prev = points[-1] if points else [0, 0]
+                        segments.append({"seconds": t - prev[0], "bytes": offset - prev[1],
+                                         "line": lastLine})
+                        points.append([t, offset])
+                        if strip:
+                            continue
+                    elif end:
+                        duration = int(end.group(1))
+                    elif start is None:
+                        m = cls._START.match(line)
+                        if m:
+                            start = datetime.strptime(m.group(1).decode(), cls._TIME_FORMAT)
+                    elif line.strip() and not line.startswith(cls._MESSAGE):
+                        # the job's line, not one of autodriver's messages,
+                        # which come before the job's output is dumped
+                        lastLine = line.strip().decode("utf-8", "replace")[:cls._LINE_SIZE]
+                    if strip:
+                        kept.write(line)
+            if strip:
+                kept.close()
+                os.replace(kept.name, path)
+        finally:
+            if strip and os.path.exists(kept.name):
+                kept.close()
+                os.remove(kept.name)
+
+        if start is None or not points:
+            return None
+        # from the last marker to the end of the job
+        if duration is not None:
+            segments.append({"seconds": max(duration - points[-1][0], 0),
+                             "bytes": None, "line": lastLine})
+        slowest = sorted(segments, key=lambda seg: -seg["seconds"])[:cls._SLOWEST]
+        return {"duration": duration,
+                "points": points,
+                "slowest": slowest,
+                "stalled": slowest[0]["seconds"] >= stallSeconds}
+# end of class TimingProfile
+
+# A job's phases and the phases each of them needs first.  run() starts
+# every phase whose dependencies are done, each in its own thread, so that
+# independent phases overlap.  When a phase fails, no more phases are
+# started, and once the running ones end, the first failure is raised
+# again (SystemExit from exit() included).
+class PhaseGraph():
+    def __init__(self, log, onDone=None):
+        self.log = log
+        self.onDone = onDone  # onDone(name, start time) after each phase
+        self.phases = {}
+        self.failedPhase = None  # name of the phase whose failure run() raised
+
+    def add(self, name, fn, deps=()):
+        self.phases[name] = types.SimpleNamespace(name=name, fn=fn, deps=list(deps),
+                                                  thread=None, start=None, end=None,
+                                                  error=None)
+
+    def run(self):
+        cond = threading.Condition()
+        self.startTime = time.time()
+
+        def work(phase):
+            phase.start = time.time()
+            try:
+                phase.fn()
+            except BaseException as e:
+                phase.error = e
+            if self.onDone:
+                self.onDone(phase.name, phase.start)
+            with cond:
+                phase.end = time.time()
+                cond.notify_all()
+
+        with cond:
+            while True:
+                failed = [p for p in self.phases.values() if p.error is not None]
+                if not failed:
+                    for p in self.phases.values():
+                        if p.thread is None and all(self.phases[d].end is not None
+                                                    for d in p.deps):
+                            p.thread = threading.Thread(target=work, args=(p,),
+                                                        name="phase-" + p.name, daemon=True)
+                            p.thread.start()
+                running = [p for p in self.phases.values()
+                           if p.thread is not None and p.end is None]
+                if not running:
+                    break
+                cond.wait()
+
+        if failed:
+            first = min(failed, key=lambda p: p.end)
+            self.failedPhase = first.name
+            raise first.error
+
+    # Log the chain of phases which decided the job's time: from the phase
+    # ending last, back through the dependency ending last each time.
+    # The other phases are shown with their slack, how much longer they
+    # could have taken without delaying the job.
+    def logCriticalPath(self):
+        done = [p for p in self.phases.values() if p.end is not None]
+        if not done:
+            return
+        path = []
+        phase = max(done, key=lambda p: p.end)
+        while phase:
+            path.insert(0, phase)
+            deps = [self.phases[d] for d in phase.deps if self.phases[d].end is not None]
+            phase = max(deps, key=lambda p: p.end) if deps else None
+
+        # a phase's slack: until the earliest start of the phases needing it
+        slack = {}
+        for p in done:
+            if p in path:
+                continue
+            needers = [q.start for q in done if p.name in q.deps]
+            slack[p.name] = (min(needers) if needers else path[-1].end) - p.end
+        self.log.info("critical path %.2fs: %s; off the path: %s" %
+                      (path[-1].end - self.startTime,
+                       " > ".join("%s %.2fs" % (p.name, p.end - p.start) for p in path),
+                       ", ".join("%s %.2fs (slack %.2fs)" % (p.name, p.end - p.start, slack[p.name])
+                                 for p in done if p.name in slack) or "none"))
+# end of class PhaseGraph
+
+# Outputs of successful jobs in RESULT_CACHE_DIR, keyed by the content of
+# the job's input files and the config which can change the result.  A job
+# identical to a graded one gets the cached output without a vm.  Entries
+# older than RESULT_CACHE_MAX_AGE seconds are dropped, and then the least
+# recently used ones until the cache fits in RESULT_CACHE_MAX_SIZE bytes.
+class ResultCache():
+    # config that goes into the key
+    _KEY_CONFIG = ("IMAGE_TAG", "EC2_INST_TYPE", "VM_ULIMIT_FILE_SIZE", "VM_ULIMIT_USER_PROC",
+                   "RUNJOB_TIMEOUT", "MAX_OUTPUT_FILE_SIZE", "AUTODRIVER_TIMESTAMP_INTERVAL",
+                   "TIMEZONE")
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.dir = config.RESULT_CACHE_DIR
+
+    # key of the job with inputFiles [(local path, dest name)]
+    def key(self, inputFiles):
+        h = hashlib.sha256()
+        h.update(json.dumps({"files": sorted([dest, fileHash(src)] for src, dest in inputFiles),
+                             "config": [getattr(self.config, k) for k in self._KEY_CONFIG]},
+                            sort_keys=True).encode())
+        return h.hexdigest()
+
+    # Return the path of the cached output and its meta data, or None
+    def lookup(self, key):
+        path = os.path.join(self.dir, key)
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+            if time.time() - meta["time"] > self.config.RESULT_CACHE_MAX_AGE:
+                return None
+            try:
+                os.utime(path + ".out")  # mark as recently used
+            except PermissionError:
+                pass  # stored by another user, whose graders share the cache
+        except (OSError, ValueError):
+            return None
+        return path + ".out", meta
+
+    # Keep a copy of output under key, then evict what's too old or too much
+    def store(self, key, output, meta):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            path = os.path.join(self.dir, key)
+            fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".")
+            os.close(fd)
+            shutil.copyfile(output, tmp)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path + ".out")
+            fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(meta, f)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path + ".json")
+            self.log.info("result cache: stored %s" % key)
+            self.evict()
+        except OSError as e:
+            self.log.warning("result cache: failed to store %s: %s" % (key, e))
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for f in os.listdir(self.dir):
+            if not f.endswith(".out") or f.startswith("."):
+                continue
+            path = os.path.join(self.dir, f[:-len(".out")])
+            try:
+                st = os.stat(path + ".out")
+                with open(path + ".json", "r") as fp:
+                    created = json.load(fp)["time"]
+            except (OSError, ValueError):
+                continue
+            entries.append([st.st_mtime, st.st_size, created, path])
+
+        total = sum(e[1] for e in entries)
+        for used, size, created, path in sorted(entries):
+            if now - created <= self.config.RESULT_CACHE_MAX_AGE and \
+               total <= self.config.RESULT_CACHE_MAX_SIZE:
+                continue
+            for suffix in (".json", ".out"):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+            total -= size
+            self.log.info("result cache: evicted %s" % os.path.basename(path))
+# end of class ResultCache
+
+# Recent launch-to-ssh-ready times of new vms, per region and instance
+# type, in HEDGE_HISTORY_FILE which jobs on the same host share.  Their
+# HEDGE_PERCENTILE is how long a hedged launch waits for its first vm.
+class LaunchHistory():
+    _lock = threading.Lock()
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.path = config.HEDGE_HISTORY_FILE
+
+    def read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # sorted launch times of instanceType
+    def times(self, instanceType):
+        if not self.path:
+            return []
+        return sorted(self.read().get("%s/%s" % (self.config.EC2_REGION, instanceType), []))
+
+    # seconds to wait for the first vm before launching a second one
+    def hedgeDelay(self, instanceType):
+        times = self.times(instanceType)
+        if len(times) < self.config.HEDGE_MIN_SAMPLES:
+            return self.config.HEDGE_DELAY
+        return MetricsReport.percentile(times, self.config.HEDGE_PERCENTILE)
+
+    def record(self, instanceType, seconds):
+        if not self.path:
+            return
+        with LaunchHistory._lock:
+            history = self.read()
+            times = history.setdefault("%s/%s" % (self.config.EC2_REGION, instanceType), [])
+            times.append(round(seconds, 2))
+            del times[:-self.config.HEDGE_HISTORY_SIZE]
+            try:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(history, f)
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, self.path)
+            except OSError as e:
+                self.log.warning("failed to write launch history %s: %s" % (self.path, e))
+# end of class LaunchHistory
+
+# Client-side limit on the EC2 API calls of a process, shared by its jobs
+# and, with API_LIMIT_FILE, by all grader processes on the host.  A token
+# bucket holding up to API_BURST calls is refilled at the current rate, at
+# most API_RATE calls per second, and each call takes a token, waiting for
+# it if need be.  A throttled call (RequestLimitExceeded and the like)
+# halves the rate, at most once a second and down to API_MIN_RATE, and
+# empties the bucket; each successful call raises it again by a fiftieth
+# of API_RATE.  A call still throttled after botocore's own retries is
+# retried after a jittered exponential backoff, up to API_MAX_ATTEMPTS
+# times in all.
+#
+# The bucket's state {"tokens", "time", "rate", "decreased"} is kept in
+# memory, or in API_LIMIT_FILE under an exclusive lock of the file.
+class ApiLimiter():
+    _shared = {}  # (region, access key) -> ApiLimiter
+    _sharedLock = threading.Lock()
+
+    # the stats of the call in progress in this thread and whether
+    # botocore has seen it throttled, see onRetry()
+    _local = threading.local()
+
+    # error codes meaning "slow down"
+    _THROTTLE_ERRORS = ("RequestLimitExceeded", "Throttling", "ThrottlingException",
+                        "RequestThrottled", "TooManyRequestsException")
+
+    # rate factor on throttling and the rate's step up per successful call,
+    # as a fraction of API_RATE
+    _DECREASE = 0.5
+    _INCREASE = 0.02
+
+    # first and longest backoff (seconds) of a throttled call
+    _BACKOFF_BASE = 0.5
+    _BACKOFF_CAP = 20
+
+    @classmethod
+    def shared(cls, config):
+        key = (config.EC2_REGION, config.ACCESS_KEY_ID)
+        with cls._sharedLock:
+            if key not in cls._shared:
+                cls._shared[key] = ApiLimiter(config)
+            return cls._shared[key]
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.statsLock = threading.Lock()
+        self.state = {"tokens": config.API_BURST, "time": time.time(),
+                      "rate": config.API_RATE, "decreased": 0}
+        self.log = logging.getLogger("GraderApiLimiter")
+        self.log.setLevel(logging.DEBUG)
+
+    # Apply fn to the bucket's state and return its result.  With
+    # API_LIMIT_FILE the state is read from and written back to the file,
+    # which is locked meanwhile.
+    def update(self, fn):
+        with self.lock:
+            if not self.config.API_LIMIT_FILE:
+                return fn(self.state)
+            try:
+                fd = os.open(self.config.API_LIMIT_FILE, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError as e:
+                self.log.warning("failed to open %s, limit this process only: %s" %
+                                 (self.config.API_LIMIT_FILE, e))
+                return fn(self.state)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)  # released by close()
+                try:
+                    state = json.loads(os.read(fd, 4096))
+                except ValueError:
+                    state = dict(self.state)  # new or broken file
+                result = fn(state)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, json.dumps(state).encode())
+                self.state = state
+                return result
+            finally:
+                os.close(fd)
+
+    # add the tokens earned since the state's time
+    def refill(self, state, now):
+        state["tokens"] = min(self.config.API_BURST,
+                              state["tokens"] + (now - state["time"]) * state["rate"])
+        state["time"] = now
+
+    # Take a token, waiting for it when the bucket is empty.  Return the
+    # seconds waited.
+    def acquire(self):
+        if self.config.API_RATE <= 0:
+            return 0.0
+
+        # a token not there yet is reserved, so that the waiting calls
+        # go one after the other
+        def take(state):
+            self.refill(state, time.time())
+            state["tokens"] -= 1
+            return max(0.0, -state["tokens"] / state["rate"])
+
+        wait = self.update(take)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # a call has been throttled
+    def throttled(self):
+        def slowDown(state):
+            now = time.time()
+            self.refill(state, now)
+            state["tokens"] = min(state["tokens"], 0)
+            # the calls in flight are throttled together; count them once
+            if now - state["decreased"] < 1:
+                return None
+            state["rate"] = max(self.config.API_MIN_RATE, state["rate"] * self._DECREASE)
+            state["decreased"] = now
+            return state["rate"]
+
+        if self.config.API_RATE <= 0:
+            return
+        rate = self.update(slowDown)
+        if rate is not None:
+            self.log.info("EC2 API throttled, rate down to %.2f calls/s" % rate)
+
+    # a call has succeeded
+    def succeeded(self):
+        def speedUp(state):
+            self.refill(state, time.time())
+            state["rate"] = min(self.config.API_RATE,
+                                state["rate"] + self.config.API_RATE * self._INCREASE)
+
+        # the last seen state saves a locked update in the common case
+        if self.config.API_RATE <= 0 or self.state["rate"] >= self.config.API_RATE:
+            return
+        self.update(speedUp)
 
-        self.log = logging.getLogger("GraderEc2")
+    # add to the numbers in stats, a dict like Ec2.apiStats, if any
+    def count(self, stats, calls=0, throttles=0, waitSeconds=0.0):
+        if stats is None:
+            return
+        with self.statsLock:
+            stats["calls"] += calls
+            stats["throttles"] += throttles
+            stats["wait_seconds"] += waitSeconds
+
+    # Make the call fn(*args, **kwargs) under the limit and count it in
+    # stats.  Return its result or raise its exception.
+    def call(self, stats, fn, *args, **kwargs):
+        attempt = 1
+        while True:
+            wait = self.acquire()
+            ApiLimiter._local.stats = stats
+            ApiLimiter._local.throttled = False
+            try:
+                result = fn(*args, **kwargs)
+            except ClientError as e:
+                if (e.response.get("Error", {}).get("Code") not in self._THROTTLE_ERRORS or
+                        attempt >= self.config.API_MAX_ATTEMPTS):
+                    self.count(stats, calls=1, waitSeconds=wait)
+                    raise
+                # botocore's last attempt has been counted by onRetry()
+                seen = ApiLimiter._local.throttled
+                if not seen:
+                    self.throttled()
+                backoff = random.uniform(0, min(self._BACKOFF_CAP, self._BACKOFF_BASE * 2 ** attempt))
+                self.log.debug("throttled call %s, retry %d in %.2fs" %
+                               (getattr(fn, "__name__", fn), attempt, backoff))
+                self.count(stats, calls=1, throttles=0 if seen else 1, waitSeconds=wait + backoff)
+                time.sleep(backoff)
+                attempt += 1
+                continue
+            finally:
+                ApiLimiter._local.stats = None
+            self.succeeded()
+            self.count(stats, calls=1, waitSeconds=wait)
+            return result
+
+    # Handler of botocore's "needs-retry" event, so that the throttled
+    # attempts which botocore retries on its own slow the rate down too.
+    # Returns None to leave the retry decision to botocore.
+    def onRetry(self, response=None, **kwargs):
+        if response and response[1].get("Error", {}).get("Code") in self._THROTTLE_ERRORS:
+            self.throttled()
+            self.count(getattr(ApiLimiter._local, "stats", None), throttles=1)
+            ApiLimiter._local.throttled = True
+
+    # Let botocore's retries of the client's calls adapt the rate too, see
+    # onRetry().  Clients without botocore's events, such as bench.py's,
+    # are left alone.
+    def watch(self, client):
+        events = getattr(getattr(client, "meta", None), "events", None)
+        if events is not None:
+            events.register_first("needs-retry.ec2", self.onRetry)
+# end of class ApiLimiter
+
+# A boto3 client whose API calls go through an ApiLimiter and are counted
+# in stats (None for calls of no particular job).  Paginators, waiters and
+# the other helpers of the client are passed through.
+class ApiClient():
+    def __init__(self, client, limiter, stats=None):
+        self.client = client
+        self.limiter = limiter
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name.startswith("get_") or name == "can_paginate":
+            return attr
+
+        def call(*args, **kwargs):
+            return self.limiter.call(self.stats, attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+# end of class ApiClient
+
+# Process wide watcher of instance states.  All threads waiting for their
+# instances share one background thread which polls only the instances
+# that are due, in one describe_instances call per round.  Each instance
+# is polled with jittered exponential backoff, starting sub-second.
+class InstanceWatcher():
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    # states an instance can't leave to become 'running'
+    _DEAD_STATES = ("shutting-down", "terminated", "stopping", "stopped")
+
+    @classmethod
+    def shared(cls, client):
+        with cls._sharedLock:
+            if cls._shared is None:
+                cls._shared = InstanceWatcher(client)
+            return cls._shared
+
+    def __init__(self, client):
+        self.client = client
+        self.log = logging.getLogger("GraderWatcher")
+        self.log.setLevel(logging.DEBUG)
+        self.cond = threading.Condition()
+        self.watches = {}  # instance id -> watch
+        self.thread = None
+
+    # Block until the instance reaches the state.  Return the instance's
+    # description from describe_instances and the state transitions
+    # [(from, to, seconds)] seen since the call.  Raise ValueError on
+    # timeout or when the instance dies.
+    # The instance is polled at intervals from minInterval to maxInterval.
+    def waitForState(self, instanceId, state, timeout, minInterval, maxInterval):
+        now = time.time()
+        # a new instance starts in 'pending'
+        w = types.SimpleNamespace(id=instanceId, want=state, state="pending", since=now,
+                                  delay=minInterval, maxDelay=maxInterval, due=now,
+                                  description=None, transitions=[], error=None, done=False)
+        with self.cond:
+            self.watches[instanceId] = w
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            deadline = now + timeout
+            while not w.done and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            del self.watches[instanceId]
+
+        if w.error:
+            raise ValueError(w.error)
+        if not w.done:
+            raise ValueError("instance %s timeout (%d seconds) in state '%s' before reaching '%s'" %
+                             (instanceId, timeout, w.state, state))
+        return w.description, w.transitions
+
+    # Return {instance id: description} for the instances visible to EC2.
+    # New instances may not be visible yet.
+    def describe(self, ids):
+        descriptions = {}
+        try:
+            response = self.client.describe_instances(InstanceIds=ids)
+            for reservation in response["Reservations"]:
+                for instance in reservation["Instances"]:
+                    descriptions[instance["InstanceId"]] = instance
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                self.log.warning("describe_instances failed: %s" % e)
+            elif len(ids) > 1:
+                # one invisible instance fails the whole batch. ask one by one
+                for i in ids:
+                    descriptions.update(self.describe([i]))
+        except Exception as e:
+            self.log.warning("describe_instances failed: %s" % e)
+        return descriptions
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    waiting = [w for w in self.watches.values() if not w.done]
+                    if any(w.due <= now for w in waiting):
+                        # piggyback the instances due soon on this round
+                        due = [w for w in waiting if w.due - now <= w.delay / 2]
+                        break
+                    self.cond.wait(min(w.due for w in waiting) - now if waiting else None)
+
+            descriptions = self.describe([w.id for w in due])
+
+            with self.cond:
+                now = time.time()
+                for w in due:
+                    d = descriptions.get(w.id)
+                    state = d["State"]["Name"] if d else w.state
+                    if state != w.state:
+                        self.log.info("instance %s %s -> %s after %.2f seconds" %
+                                      (w.id, w.state, state, now - w.since))
+                        w.transitions.append((w.state, state, now - w.since))
+                        w.state = state
+                        w.since = now
+
+                    if state == w.want:
+                        w.description = d
+                        w.done = True
+                    elif w.want == "running" and state in self._DEAD_STATES:
+                        w.error = "instance %s went to '%s' while waiting for 'running'" % (w.id, state)
+                        w.done = True
+                    else:
+                        w.delay = min(w.delay * 2, w.maxDelay)
+                        w.due = now + w.delay * random.uniform(0.5, 1.0)
+                self.cond.notify_all()
+    # end of InstanceWatcher.loop()
+# end of class InstanceWatcher
+
+# The cloud dependent module, one per job (or vm pool manager).  What is
+# expensive to make, boto3 clients and the image lookup, is shared by all
+# Ec2 objects of the process.
+class Ec2():
+    _lock = threading.Lock()
+    _clients = {}  # (region, access key) -> boto3 client
+    _images = {}   # "<region>/<image tag>" -> {"id": image id, "time": lookup time}
+    _secGroupIds = {}  # (region, group name) -> id of a shared security group
+
+    # errors of run_instances() saying the image id is no good
+    _INVALID_IMAGE_ERRORS = ("InvalidAMIID.NotFound",
+                             "InvalidAMIID.Unavailable",
+                             "InvalidAMIID.Malformed")
+
+    def __init__(self, config, logPrefix=""):
+        self.config = config
+        self.imageId = None
+
+        # the name tag of imageId: IMAGE_TAG, or with findImage(bakeFiles)
+        # that of an image baked by ImageBaker, see baked
+        self.imageTag = config.IMAGE_TAG
+        self.baked = False
+
+        # the job's own security group, see createSecurityGroup().  Not
+        # used with SHARED_SECURITY_GROUP, see sharedSecurityGroup()
+        self.secGroup = None
+        self.secGroupID = None
+
+        self.log = logging.getLogger(logPrefix + "GraderEc2")
         self.log.setLevel(logging.DEBUG)
         logging.getLogger('boto3').setLevel(logging.WARNING)
         logging.getLogger('botocore').setLevel(logging.WARNING)
 
+        # the job's EC2 API calls, throttled ones and seconds spent waiting
+        # for the rate limit, see ApiLimiter
+        self.apiStats = {"calls": 0, "throttles": 0, "wait_seconds": 0.0}
+
+        self.key = (config.EC2_REGION, config.ACCESS_KEY_ID)
+        try:
+            self.boto3client = Ec2.sharedClient(config, self.apiStats)
+        except Exception as e:
+            self.log.error("Ec2SSH init Failed: %s"% e)
+            raise  # serious error
+    # end of Ec2. __init__()
+
+    # Find the image to launch vms from.  Simply exit on failure.  With
+    # bakeFiles, [local path, dest] pairs of the job's inputFiles, prefer
+    # the image ImageBaker made of the base image and those files, if any;
+    # baked tells which one was found
+    def findImage(self, bakeFiles=()):
         try:
-            self.boto3client = boto3.client("ec2", config.EC2_REGION,
-                                            aws_access_key_id=config.ACCESS_KEY_ID,
-                                            aws_secret_access_key=config.SECRET_ACCESS_KEY)
-            self.boto3resource = boto3.resource("ec2", config.EC2_REGION,
-                                                aws_access_key_id=config.ACCESS_KEY_ID,
-                                                aws_secret_access_key=config.SECRET_ACCESS_KEY)
-            images = self.boto3resource.images.filter(Owners=["self"])
+            self.imageId = self.resolveImage()
         except Exception as e:
             self.log.error("Ec2SSH init Failed: %s"% e)
             raise  # serious error
 
-        # Assumption: The image for grading vm is tagged with IMAGE_TAG in the config
-        for image in images:
-            if image.tags:
-                for tag in image.tags:
-                    if tag["Key"] == "Name":
-                        if tag["Value"]:
-                            if tag["Value"] == config.IMAGE_TAG:
-                                if self.image is not None:
-                                    self.log.warning("Found duplicate name tag %s on image %s, ignore" %
-                                                     (config.IMAGE_TAG, image.id))
-                                else:
-                                    self.log.info("Found image %s with name tag %s" %
-                                                  (image.id, config.IMAGE_TAG))
-                                    self.image = image
-
-        if (self.image is None):
-            self.log.error("Failed to find image with tag %s" % config.IMAGE_TAG)
+        if (self.imageId is None):
+            self.log.error("Failed to find image with tag %s" % self.imageTag)
             exit(-1)
-    # end of Ec2. __init__()
+
+        if not bakeFiles:
+            return
+        baseId = self.imageId
+        self.imageTag = ImageBaker.imageTag(self.config, baseId, bakeFiles)
+        try:
+            imageId = self.resolveImage()
+        except Exception as e:
+            self.log.warning("failed to look up baked image %s: %s" % (self.imageTag, e))
+            imageId = None
+        if imageId is None:
+            self.log.info("no baked image %s, use image %s and copy the files in" %
+                          (self.imageTag, baseId))
+            self.imageTag = self.config.IMAGE_TAG
+            return
+        self.imageId = imageId
+        self.baked = True
+
+    # the process' boto3 client for the config's region and account, with
+    # its calls rate limited by the shared ApiLimiter and counted in stats
+    @staticmethod
+    def sharedClient(config, stats=None):
+        key = (config.EC2_REGION, config.ACCESS_KEY_ID)
+        limiter = ApiLimiter.shared(config)
+        with Ec2._lock:
+            if key not in Ec2._clients:
+                Ec2._clients[key] = boto3.client("ec2", config.EC2_REGION,
+                                                 aws_access_key_id=config.ACCESS_KEY_ID,
+                                                 aws_secret_access_key=config.SECRET_ACCESS_KEY)
+                limiter.watch(Ec2._clients[key])
+            return ApiClient(Ec2._clients[key], limiter, stats)
+
+    # Return the id of the image tagged with imageTag, or None.  The id is
+    # cached in memory and in IMAGE_CACHE_FILE for IMAGE_CACHE_TTL seconds,
+    # so that most jobs don't ask EC2 at all.
+    def resolveImage(self):
+        start_time = time.time()
+        key = "%s/%s" % (self.config.EC2_REGION, self.imageTag)
+
+        def fresh(entry):
+            return entry is not None and time.time() - entry["time"] < self.config.IMAGE_CACHE_TTL
+
+        with Ec2._lock:
+            entry = Ec2._images.get(key)
+        source = "memory"
+        if not fresh(entry) and self.config.IMAGE_CACHE_FILE:
+            entry = self.readImageCache().get(key)
+            source = "disk"
+        if fresh(entry):
+            with Ec2._lock:
+                Ec2._images[key] = entry
+            self.log.info("image cache hit (%s): image %s with name tag %s, age %ds, took %.3fs" %
+                          (source, entry["id"], self.imageTag,
+                           time.time() - entry["time"], time.time() - start_time))
+            return entry["id"]
+
+        imageId = self.lookupImage()
+        self.log.info("image cache miss: looked up image %s with name tag %s in %.3fs" %
+                      (imageId, self.imageTag, time.time() - start_time))
+        if imageId is None or self.config.IMAGE_CACHE_TTL <= 0:
+            return imageId
+
+        entry = {"id": imageId, "time": time.time()}
+        with Ec2._lock:
+            Ec2._images[key] = entry
+        self.updateImageCache(key, entry)
+        return imageId
+
+    # Ask EC2 for the available image tagged with imageTag.  The tag is
+    # matched on the server side.
+    # Assumption: The image for grading vm is tagged with IMAGE_TAG in the config
+    def lookupImage(self):
+        response = self.boto3client.describe_images(
+            Owners=["self"],
+            Filters=[{"Name": "tag:Name", "Values": [self.imageTag]},
+                     {"Name": "state", "Values": ["available"]}])
+        images = sorted(response["Images"], key=lambda i: i.get("CreationDate", ""))
+        for image in images[:-1]:
+            self.log.warning("Found duplicate name tag %s on image %s, ignore" %
+                             (self.imageTag, image["ImageId"]))
+        if not images:
+            return None
+        self.log.info("Found image %s with name tag %s" %
+                      (images[-1]["ImageId"], self.imageTag))
+        return images[-1]["ImageId"]
+
+    # The image cache file is shared by the jobs (processes) on this host.
+    def readImageCache(self):
+        try:
+            with open(self.config.IMAGE_CACHE_FILE, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Set (or with entry None, remove) key in the image cache file.  The file
+    # is replaced, never rewritten in place, so readers never see half of it.
+    def updateImageCache(self, key, entry):
+        if not self.config.IMAGE_CACHE_FILE:
+            return
+        cache = self.readImageCache()
+        if entry is None:
+            cache.pop(key, None)
+        else:
+            cache[key] = entry
+        try:
+            directory = os.path.dirname(os.path.abspath(self.config.IMAGE_CACHE_FILE))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".image-cache")
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, self.config.IMAGE_CACHE_FILE)
+        except OSError as e:
+            self.log.warning("failed to update image cache %s: %s" %
+                             (self.config.IMAGE_CACHE_FILE, e))
+
+    # Forget the cached image id, e.g. after the image has been deregistered
+    def invalidateImage(self):
+        key = "%s/%s" % (self.config.EC2_REGION, self.imageTag)
+        self.log.info("image cache invalidated for %s" % key)
+        with Ec2._lock:
+            Ec2._images.pop(key, None)
+        self.updateImageCache(key, None)
+
+    # Create a security group allowing ssh and ping and return its id
+    def makeSecurityGroup(self, name):
+        response = self.boto3client.create_security_group(
+            GroupName=name,
+            Description="Autolab grading vm - allowing ssh and ping")
+        groupId = response['GroupId']
+        self.log.info("sec group created: %s %s" % (name, groupId))
+        self.boto3client.authorize_security_group_ingress(
+            GroupId=groupId,
+            # rules for ssh and ping
+            IpPermissions=[
+                {'IpProtocol': 'tcp',
+                 'ToPort': 22,
+                 'FromPort': 22,
+                 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+                },
+                {'IpProtocol': 'icmp',
+                 'FromPort': 8,
+                 'ToPort': 0,
+                 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
+                 }
+            ])
+        return groupId
 
     def createSecurityGroup(self):
         # Create may-exist security group
         try:
-            response = self.boto3client.create_security_group(
-                GroupName=secGroup,
-                Description="Autolab grading vm - allowing ssh and ping")
-            global secGroupID
-            secGroupID = response['GroupId']
-            self.log.info("sec group created: %s %s" % (secGroup, secGroupID))
-            self.boto3client.authorize_security_group_ingress(
-                GroupId=secGroupID,
-                # rules for ssh and ping
-                IpPermissions=[
-                    {'IpProtocol': 'tcp',
-                     'ToPort': 22,
-                     'FromPort': 22,
-                     'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                    },
-                    {'IpProtocol': 'icmp',
-                     'FromPort': 8,
-                     'ToPort': 0,
-                     'IpRanges': [{'CidrIp': '0.0.0.0/0'}]
-                     }
-                ])
+            self.secGroupID = self.makeSecurityGroup(self.secGroup)
         except ClientError as e:
             pass
 
-    def initializeVM(self):
+    # Return the id of the security group SHARED_SECURITY_GROUP, making the
+    # group if it doesn't exist yet.  The id is remembered by the process
+    # and the group is never deleted by a job.
+    def sharedSecurityGroup(self):
+        name = self.config.SHARED_SECURITY_GROUP
+        key = (self.config.EC2_REGION, name)
+        with Ec2._lock:
+            groupId = Ec2._secGroupIds.get(key)
+        if groupId:
+            return groupId
+
+        def find():
+            response = self.boto3client.describe_security_groups(
+                Filters=[{"Name": "group-name", "Values": [name]}])
+            groups = response["SecurityGroups"]
+            return groups[0]["GroupId"] if groups else None
+
+        groupId = find()
+        if groupId is None:
+            try:
+                groupId = self.makeSecurityGroup(name)
+            except ClientError as e:
+                # another job has just made it
+                if e.response["Error"]["Code"] != "InvalidGroup.Duplicate":
+                    raise
+                groupId = find()
+        self.log.info("shared sec group: %s %s" % (name, groupId))
+        with Ec2._lock:
+            Ec2._secGroupIds[key] = groupId
+        return groupId
+
+    # forget the shared group's id, e.g. after the group has been deleted
+    def invalidateSharedSecurityGroup(self):
+        with Ec2._lock:
+            Ec2._secGroupIds.pop((self.config.EC2_REGION, self.config.SHARED_SECURITY_GROUP), None)
+
+    # Make sure the vms' security group exists, before launching
+    def prepareSecurityGroup(self):
+        if self.config.SHARED_SECURITY_GROUP:
+            self.sharedSecurityGroup()
+        elif self.secGroupID is None:
+            self.createSecurityGroup()
+
+    # Launch the vm and return the reservation from run_instances.  The vm
+    # is named at launch, saving a create_tags call.  A vm with a subnet_id
+    # must name its security group by id.
+    def launchInstance(self, vm):
+        if self.config.SHARED_SECURITY_GROUP:
+            group = {"SecurityGroupIds": [self.sharedSecurityGroup()]}
+        elif vm.subnet_id:
+            if self.secGroupID is None:
+                raise ValueError("id of sec group %s is unknown" % self.secGroup)
+            group = {"SecurityGroupIds": [self.secGroupID]}
+        else:
+            group = {"SecurityGroups": [self.secGroup]}
+        if vm.subnet_id:
+            group["SubnetId"] = vm.subnet_id
+        if vm.name:
+            group["TagSpecifications"] = [{"ResourceType": "instance",
+                                           "Tags": [{"Key": "Name", "Value": vm.name}]}]
+        return self.boto3client.run_instances(ImageId=self.imageId,
+                                              InstanceType=vm.instance_type,
+                                              KeyName=self.config.SECURITY_KEY_NAME,
+                                              MaxCount=1,
+                                              MinCount=1,
+                                              **group)
+
+    # Launch a vm and wait for it to reach 'running'.  Raise on failure,
+    # after terminating the instance if it has been created.
+    def createVM(self, vm):
         newInstance = None
 
         try:
             self.log.info("initializeVM: %s" % vm.configStr())
 
             # ensure that security group exists
-            self.createSecurityGroup()
-
-            reservation = self.boto3resource.create_instances(ImageId=self.image.id,
-                                                              InstanceType=config.EC2_INST_TYPE,
-                                                              KeyName=config.SECURITY_KEY_NAME,
-                                                              SecurityGroups=[
-                                                                  secGroup],
-                                                              MaxCount=1,
-                                                              MinCount=1)
+            self.prepareSecurityGroup()
 
-            # Sleep for a while to prevent random transient errors observed
-            # when the instance is not available yet
-            time.sleep(config.TIMER_POLL_INTERVAL)
-
-            newInstance = reservation[0]
-            if not newInstance:
+            try:
+                reservation = self.launchInstance(vm)
+            except ClientError as e:
+                # the cached image or shared group may be gone.  Look it up
+                # again and retry once
+                code = e.response["Error"]["Code"]
+                if code in self._INVALID_IMAGE_ERRORS:
+                    self.log.warning("image %s is invalid: %s" % (self.imageId, e))
+                    self.invalidateImage()
+                    self.imageId = self.resolveImage()
+                    if self.imageId is None:
+                        raise ValueError("cannot find image with tag %s" % self.imageTag)
+                elif code == "InvalidGroup.NotFound":
+                    self.log.warning("sec group is gone: %s" % e)
+                    if self.config.SHARED_SECURITY_GROUP:
+                        self.invalidateSharedSecurityGroup()
+                    self.secGroupID = None
+                    self.prepareSecurityGroup()
+                else:
+                    raise
+                reservation = self.launchInstance(vm)
+
+            if not reservation.get("Instances"):
                 raise ValueError("cannot find new instance for %s" % vm.configStr())
+            newInstance = reservation["Instances"][0]["InstanceId"]
+            # known from now on, so that a dropped vm can be terminated early
+            vm.instance_id = newInstance
+
+            # Wait for instance to reach 'running' state.  The watcher asks
+            # about this instance only, batched with other jobs' instances.
+            description, vm.state_transitions = InstanceWatcher.shared(
+                Ec2.sharedClient(self.config)).waitForState(newInstance, "running",
+                                               self.config.INITIALIZEVM_TIMEOUT,
+                                               self.config.INITIALIZEVM_POLL_MIN_INTERVAL,
+                                               self.config.INITIALIZEVM_POLL_MAX_INTERVAL)
+            self.log.info("VM is running. instance id: %s" % newInstance)
 
-            # Wait for instance to reach 'running' state
-            start_time = time.time()
-            while True:
-                # Note: You'd think we should be able to read the state from the
-                # instance but that turns out not working.  So we round up all
-                # running intances and find our instance by instance id
-
-                filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-                instances = self.boto3resource.instances.filter(Filters=filters)
-                instanceRunning = False
-
-                newInstance.load()  # reload the state of the instance
-                for inst in instances.filter(InstanceIds=[newInstance.id]):
-                    self.log.info("VM is running. instance id: %s" % newInstance.id)
-                    instanceRunning = True
-
-                if instanceRunning:
-                    break
-
-                if time.time() - start_time > config.INITIALIZEVM_TIMEOUT:
-                    raise ValueError("vm %s timeout (%d seconds) before reaching 'running' state" %
-                                     (vm.configStr(), config.INITIALIZEVM_TIMEOUT))
-
-                self.log.debug("Waiting for vm to reach 'running' from 'pending'")
-                time.sleep(config.TIMER_POLL_INTERVAL)
-            # end of while loop
-
-            # Assign name to EC2 instance
-            self.boto3resource.create_tags(Resources=[newInstance.id],
-                                           Tags=[{"Key": "Name", "Value": vm.name}])
-            self.log.debug("name tag %s created for the vm" % vm.name)
+            # Save domain and id ssigned by EC2 in vm object
+            vm.public_ip = description.get("PublicIpAddress")
+            vm.image_id = self.imageId
+            vm.instance = description
 
             self.log.info(
                 "VM State %s | Reservation %s | Public DNS %s | Public IP %s" %
-                (newInstance.state,
-                 reservation,
-                 newInstance.public_dns_name,
-                 newInstance.public_ip_address))
-
-            # Save domain and id ssigned by EC2 in vm object
-            vm.public_ip = newInstance.public_ip_address
-            vm.image = self.image
-            vm.image_id = self.image.id
-            vm.instance = newInstance
-            vm.instance_id = newInstance.id
+                (description["State"],
+                 reservation.get("ReservationId"),
+                 description.get("PublicDnsName"),
+                 vm.public_ip))
             return
 
-        except Exception as e:
-            self.log.error("initializeVM Failed: %s" % e)
+        except Exception:
             if newInstance:
                 try:
-                    self.boto3resource.instances.filter(InstanceIds=[newInstance.id]).terminate()
-                except Exception as e:
-                    self.log.error("Exception when terminating: %s" % e)
+                    self.boto3client.terminate_instances(InstanceIds=[newInstance])
+                except Exception as e2:
+                    self.log.error("Exception when terminating: %s" % e2)
+            raise
+    # end of Ec2.createVM()
+
+    # simply exit on failure
+    def initializeVM(self, vm):
+        try:
+            self.createVM(vm)
+        except Exception as e:
+            self.log.error("initializeVM Failed: %s" % e)
             exit(-1)
-    # end of Ec2.initializeVM()
+
+    def tagVM(self, vm):
+        self.boto3client.create_tags(Resources=[vm.instance_id],
+                                     Tags=[{"Key": "Name", "Value": vm.name}])
+        self.log.debug("name tag %s created for the vm" % vm.name)
+
+    # Take over a running vm made elsewhere (e.g. claimed from the vm pool)
+    # and rename it after the job.
+    def adoptVM(self, vm):
+        vm.image_id = self.imageId
+        vm.instance = {"InstanceId": vm.instance_id}
+        self.tagVM(vm)
+
+    def terminateVM(self, vm):
+        self.log.info("terminate vm %s" % vm)
+        self.boto3client.terminate_instances(InstanceIds=[vm.instance_id])
+
+    # Before the vms in the group are actually terminated, the group
+    # can't be deleted.  Retry for up to totalWait seconds.
+    def deleteSecurityGroup(self, totalWait=120):
+        if self.secGroupID is None:
+            return
+        while True:
+            try:
+                self.boto3client.delete_security_group(GroupId=self.secGroupID)
+                self.log.info("sec group deleted: %s %s" % (self.secGroup, self.secGroupID))
+                self.secGroupID = None
+                break
+            except Exception as e:
+                if totalWait <= 0:
+                    self.log.error("failed to delete sec group: %s" % self.secGroup)
+                    break
+                self.log.info("delete sec group exception: %s" % e)
+                self.log.info("delete sec group wait time left: %s" % totalWait)
+                time.sleep(15)
+                totalWait -= 15
 
     # Note: Do NOT use exit() in destroyVM.
     # The caller may want to do more end-of-job work after calling it.
-    def destroyVM(self, notes=None):
-        global secGroupID
-        if (vm is None or vm.instance is None) and secGroupID is None:
+    def destroyVM(self, vm, notes=None):
+        # the instance id is known as soon as the vm is launched, before
+        # createVM() or adoptVM() sets vm.instance
+        if vm is not None and (vm.instance_id is None or vm.destroyed):
+            vm = None
+        if vm is None and self.secGroupID is None:
             return
         # mark the vm as being destroyed
-        vm.instance = None
+        if vm:
+            vm.destroyed = True
+            vm.instance = None
 
         self.log.info("destroyVM: %s" % vm)
 
         try:
             # Keep the vm and mark with meaningful tags for debugging
-            if config.KEEP_VM_AFTER_FAILURE:
+            if self.config.KEEP_VM_AFTER_FAILURE and vm and vm.instance_id:
                 self.log.info("Will keep VM %s for further debugging" % vm.name)
-                instance = self.boto3resource.Instance(vm.instance_id)
                 # delete original name tag "xyz" and replace it with "keep-xyz"
                 # add notes tag to give a reason
-                tag = self.boto3resource.Tag(vm.instance_id, "Name", vm.name)
-                if tag:
-                    tag.delete()
-                instance.create_tags(Tags=[{"Key": "Name", "Value": "keep-" + vm.name}])
+                self.boto3client.delete_tags(Resources=[vm.instance_id],
+                                             Tags=[{"Key": "Name", "Value": vm.name}])
+                tags = [{"Key": "Name", "Value": "keep-" + vm.name}]
                 if notes:
-                    instance.create_tags(Tags=[{"Key": "Notes", "Value": notes}])
+                    tags.append({"Key": "Notes", "Value": notes})
+                self.boto3client.create_tags(Resources=[vm.instance_id], Tags=tags)
                 return
-            if vm.instance_id:
-                self.boto3resource.instances.filter(InstanceIds=[vm.instance_id]).terminate()
-
-            totalWait = 120
-            while True:
+            # let the reaper terminate the vm and delete the group
+            if self.config.REAPER_DIR:
                 try:
-                    self.boto3client.delete_security_group(GroupId=secGroupID)
-                    self.log.info("sec group deleted: %s %s" % (secGroup, secGroupID))
-                    secGroupID = None
-                    break
-                except Exception as e:
-                    # before vm is actually terminated, sec group can't be deleted
-                    # wait for a while before giving up
-                    if totalWait <= 0:
-                        self.log.error("failed to delete sec group: %s" % secGroup)
-                        break
-                    self.log.info("delete sec group exception: %s" % e)
-                    self.log.info("delete sec group wait time left: %s" % totalWait)
-                    time.sleep(15)
-                    totalWait -= 15
+                    Reaper.handOff(self.config, vm, self.secGroupID, notes)
+                    self.log.info("handed vm %s and sec group %s to the reaper" %
+                                  (vm, self.secGroupID))
+                    self.secGroupID = None
+                    return
+                except OSError as e:
+                    self.log.error("failed to hand off to the reaper: %s" % e)
+
+            if vm and vm.instance_id:
+                self.terminateVM(vm)
+
+            self.deleteSecurityGroup()
 
         except Exception as e:
             self.log.error("destroyVM Failed: %s" % e)
@@ -261,49 +1314,620 @@ class Ec2():
     # end of Ec2.destroyVM()
 # end of class Ec2
 
-class Grader():
-    _SECURITY_KEY_PATH_INDEX_IN_SSH_FLAGS = 1
-
-    def __init__(self):
-        error = []  # store errors before logging is ready
+# Warm pool of grading vms that have already passed the ssh probe.
+#
+# The pool is a directory shared by the pool manager ("grader.py --pool")
+# and the jobs: <VM_POOL_DIR>/<IMAGE_TAG>_<EC2_INST_TYPE>/ holds one json
+# file per ready vm, named <ready time in ms>_<instance id>.json so that
+# the oldest sorts first.  A job claims a vm by renaming its file, which is
+# atomic, so two jobs never get the same vm.  The manager refills the pool
+# in background threads and shrinks it to VM_POOL_MIN_SIZE when no vm has
+# been claimed for VM_POOL_IDLE_TIMEOUT seconds.
+#
+# The cloud backend is any object with createVM(vm) and terminateVM(vm),
+# such as Ec2, and the prober any object with probeVM(vm), such as Grader.
+class VMPool():
+    def __init__(self, config, cloud=None, prober=None):
+        self.config = config
+        self.cloud = cloud
+        self.prober = prober
+        self.dir = os.path.join(self.config.VM_POOL_DIR,
+                                "%s_%s" % (self.config.IMAGE_TAG, self.config.EC2_INST_TYPE))
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.log = logging.getLogger("GraderPool")
+        self.log.setLevel(logging.DEBUG)
 
-        # read config defaults and updates. Then convert to dot form
-        with open('config_defaults.yaml', 'r') as f:
-            defaults = yaml.load(f, Loader=yaml.FullLoader)
-        with open(os.path.join(defaults['passedInDir'], 'config.yaml'), 'r') as f:
-            updates = yaml.load(f, Loader=yaml.FullLoader)
-        defaults.update(updates)
+        # the following are used by the manager only
+        self.lock = threading.Lock()
+        self.booting = 0
+        self.bootCount = 0
+        self.stopping = False
+        self.published = set()  # ids of the vms the manager put in the pool
+        self.lastClaimTime = time.time()
+
+    def readyFiles(self):
+        return sorted(f for f in os.listdir(self.dir)
+                      if f.endswith(".json") and not f.startswith("."))
+
+    # Remove a vm from the pool.  Return its VM object or None if another
+    # process has taken it first.
+    def take(self, f):
+        src = os.path.join(self.dir, f)
+        taken = "%s.taken-%d-%d" % (src, os.getpid(), threading.get_ident())
+        try:
+            os.rename(src, taken)
+        except OSError:
+            return None
+        try:
+            with open(taken, "r") as fp:
+                d = json.load(fp)
+        finally:
+            os.remove(taken)
+
+        vm = VM(image_tag=self.config.IMAGE_TAG, instance_type=self.config.EC2_INST_TYPE, name=d["name"])
+        vm.public_ip = d["public_ip"]
+        vm.instance_id = d["instance_id"]
+        return vm
+
+    # for jobs: return a ready vm or None if the pool is empty
+    def claim(self):
+        start_time = time.time()
+        for f in self.readyFiles():
+            vm = self.take(f)
+            if vm:
+                self.log.info("claimed %s from pool %s in %.3f seconds" %
+                              (vm, self.dir, time.time() - start_time))
+                return vm
+        self.log.info("pool %s is empty" % self.dir)
+        return None
+
+    def publish(self, vm):
+        readyTime = int(time.time() * 1000)
+        f = "%013d_%s.json" % (readyTime, vm.instance_id)
+        tmp = os.path.join(self.dir, "." + f)  # invisible to readyFiles()
+        with open(tmp, "w") as fp:
+            json.dump({"name": vm.name,
+                       "public_ip": vm.public_ip,
+                       "instance_id": vm.instance_id,
+                       "ready_time": readyTime / 1000}, fp)
+        os.rename(tmp, os.path.join(self.dir, f))
+        with self.lock:
+            self.published.add(vm.instance_id)
+        self.log.info("vm %s %s added to pool" % (vm.name, vm))
+
+    def bootVM(self):
+        with self.lock:
+            self.bootCount += 1
+            name = "pool_%s_%s_%d" % (self.config.IMAGE_TAG,
+                                      time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime()),
+                                      self.bootCount)
+        vm = VM(image_tag=self.config.IMAGE_TAG, instance_type=self.config.EC2_INST_TYPE, name=name)
+        start_time = time.time()
+        try:
+            self.cloud.createVM(vm)
+            if not self.prober.probeVM(vm):
+                raise ValueError("%s not ready after %d seconds" % (vm, self.config.WAITVM_TIMEOUT))
+            self.log.info("booted vm %s in %.1f seconds" % (vm, time.time() - start_time))
+            if self.stopping:
+                self.cloud.terminateVM(vm)
+            else:
+                self.publish(vm)
+        except Exception as e:
+            self.log.error("failed to boot pool vm %s: %s" % (name, e))
+            if vm.instance_id:
+                try:
+                    self.cloud.terminateVM(vm)
+                except Exception as e2:
+                    self.log.error("Exception when terminating: %s" % e2)
+            # don't hammer the cloud when launches keep failing
+            time.sleep(self.config.VM_POOL_CHECK_INTERVAL * 10)
+        finally:
+            with self.lock:
+                self.booting -= 1
+
+    def retireVM(self, f):
+        vm = self.take(f)
+        if vm:
+            with self.lock:
+                self.published.discard(vm.instance_id)
+            try:
+                self.cloud.terminateVM(vm)
+            except Exception as e:
+                self.log.error("failed to terminate pool vm %s: %s" % (vm, e))
+
+    # one round of the manager: notice claims, then grow or shrink the pool
+    def adjust(self):
+        ready = self.readyFiles()
+        readyIds = set(f[14:-5] for f in ready)
+        with self.lock:
+            claimed = self.published - readyIds
+            self.published -= claimed
+            booting = self.booting
+        if claimed:
+            self.lastClaimTime = time.time()
+            self.log.info("%d vm(s) claimed from pool" % len(claimed))
+
+        target = self.config.VM_POOL_SIZE
+        if time.time() - self.lastClaimTime > self.config.VM_POOL_IDLE_TIMEOUT:
+            target = self.config.VM_POOL_MIN_SIZE
+
+        if len(ready) + booting < target:
+            for i in range(target - len(ready) - booting):
+                with self.lock:
+                    self.booting += 1
+                threading.Thread(target=self.bootVM, daemon=True).start()
+        elif len(ready) > target and booting == 0:
+            self.log.info("pool idle, shrinking from %d to %d vms" % (len(ready), target))
+            for f in ready[:len(ready) - target]:
+                self.retireVM(f)
+
+    def manage(self):
+        self.log.info("managing pool %s, size %d (%d when idle)" %
+                      (self.dir, self.config.VM_POOL_SIZE, self.config.VM_POOL_MIN_SIZE))
+        try:
+            while True:
+                self.adjust()
+                time.sleep(self.config.VM_POOL_CHECK_INTERVAL)
+        except (KeyboardInterrupt, SystemExit):
+            self.log.info("pool manager stopping")
+        finally:
+            self.drain()
+
+    # terminate all vms in and on their way to the pool
+    def drain(self):
+        self.stopping = True
+        for f in self.readyFiles():
+            self.retireVM(f)
+        deadline = time.time() + self.config.INITIALIZEVM_TIMEOUT + self.config.WAITVM_TIMEOUT
+        while self.booting > 0 and time.time() < deadline:
+            time.sleep(1)
+        self.cloud.deleteSecurityGroup()
+
+    @staticmethod
+    def main():
+        prober = Grader(forJob=False)
+        if not config.VM_POOL_DIR:
+            prober.log.error("VM_POOL_DIR is not set")
+            exit(-1)
 
-        # all config must be there
-        for key in defaults:
-            if defaults[key] is None:
-                error.append("config %s is missing" % key)
-                break
+        # turn "docker stop" into a normal exit so the pool is drained
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        cloud = Ec2(config)
+        cloud.findImage()
+        cloud.secGroup = "secGroup_pool_%s_%s" % (config.IMAGE_TAG,
+                                                  time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime()))
+        VMPool(config, cloud, prober).manage()
+# end of class VMPool
+
+# Background terminator of grading vms ("grader.py --reap", or a thread of
+# the grading service).
+#
+# With REAPER_DIR set, a job doesn't wait for its vm's termination and its
+# security group's deletion.  It writes a json file naming them into
+# REAPER_DIR and is done.  Every REAPER_INTERVAL seconds the reaper
+# terminates all handed-off vms with one call, then deletes their groups
+# once the vms are gone, retrying what fails in the next round.  Every
+# REAPER_SWEEP_INTERVAL seconds it also looks for vms and groups made by
+# the grader that are older than REAPER_MAX_AGE (REAPER_KEEP_MAX_AGE for
+# vms kept for debugging), which an exited job has leaked, and removes them.
+# The reaper of the grading service leaves the hosts of its packer alone.
+class Reaper():
+    # most instance ids in one terminate_instances call
+    _BATCH_SIZE = 500
+
+    def __init__(self, config, client, packer=None):
+        self.config = config
+        self.client = client
+        self.packer = packer
+        self.dir = config.REAPER_DIR
+        os.makedirs(self.dir, exist_ok=True)
+        self.lastSweepTime = 0
+        self.stopping = False
+
+        self.log = logging.getLogger("GraderReaper")
+        self.log.setLevel(logging.DEBUG)
 
-        # some size config are like "1024*1024".  eval here
-        for a in defaults:
-            if a.endswith('_SIZE'):
-                defaults[a] = int(eval(defaults[a]))
+    # Called by a job: leave the vm and the security group id to the reaper
+    @staticmethod
+    def handOff(config, vm, secGroupID, notes=None):
+        entry = {"instance_id": vm.instance_id if vm else None,
+                 "name": vm.name if vm else None,
+                 "sec_group_id": secGroupID,
+                 "notes": notes,
+                 "time": time.time(),
+                 "terminated": not (vm and vm.instance_id)}
+        os.makedirs(config.REAPER_DIR, exist_ok=True)
+        Reaper.writeEntry(config.REAPER_DIR,
+                          "%s.json" % (entry["instance_id"] or secGroupID), entry)
+
+    # write atomically, so the reaper never reads half an entry
+    @staticmethod
+    def writeEntry(directory, filename, entry):
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.rename(tmp, os.path.join(directory, filename))
+
+    def readEntries(self):
+        entries = {}
+        for f in os.listdir(self.dir):
+            if f.startswith(".") or not f.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.dir, f), "r") as fp:
+                    entries[f] = json.load(fp)
+            except (OSError, ValueError) as e:
+                self.log.error("bad reaper entry %s: %s" % (f, e))
+        return entries
+
+    # Terminate the instances in batches.  Return the ids which are gone
+    # or going.  A failing batch is retried one instance at a time, so that
+    # one bad id doesn't hold up the others.
+    def terminate(self, ids):
+        done = set()
+        for i in range(0, len(ids), self._BATCH_SIZE):
+            batch = ids[i:i + self._BATCH_SIZE]
+            try:
+                self.client.terminate_instances(InstanceIds=batch)
+                done.update(batch)
+                continue
+            except ClientError as e:
+                if len(batch) == 1:
+                    batch = []
+                    if e.response["Error"]["Code"] == "InvalidInstanceID.NotFound":
+                        done.add(ids[i])
+                    else:
+                        self.log.error("failed to terminate %s: %s" % (ids[i], e))
+                else:
+                    self.log.warning("failed to terminate %d instances, try one by one: %s" %
+                                     (len(batch), e))
+            for instanceId in batch:
+                done.update(self.terminate([instanceId]))
+        return done
+
+    # Delete the security group.  Return True when it's gone.
+    def deleteSecurityGroup(self, groupId):
+        try:
+            self.client.delete_security_group(GroupId=groupId)
+            self.log.info("sec group deleted: %s" % groupId)
+            return True
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code == "InvalidGroup.NotFound":
+                return True
+            # DependencyViolation: the instances in it are still shutting down
+            if code != "DependencyViolation":
+                self.log.error("failed to delete sec group %s: %s" % (groupId, e))
+            return False
+
+    # one round over the handed-off vms and groups
+    def reap(self):
+        entries = self.readEntries()
+        if not entries:
+            return
 
-        # set global config in dot form, such as config.IMAGE_TAG
-        global config
-        config = types.SimpleNamespace(**defaults)
+        ids = [e["instance_id"] for e in entries.values() if not e["terminated"]]
+        done = self.terminate(ids) if ids else set()
+        if done:
+            self.log.info("terminated %d instances: %s" % (len(done), " ".join(sorted(done))))
 
-        # course number as image tag can be read as a number. convert to str
-        config.IMAGE_TAG = str(config.IMAGE_TAG)
+        for f, entry in entries.items():
+            if entry["instance_id"] in done:
+                entry["terminated"] = True
+            if entry["terminated"] and (entry["sec_group_id"] is None or
+                                        self.deleteSecurityGroup(entry["sec_group_id"])):
+                try:
+                    os.remove(os.path.join(self.dir, f))
+                except FileNotFoundError:
+                    pass  # removed by another reaper
+            elif entry["instance_id"] in done:
+                Reaper.writeEntry(self.dir, f, entry)
+
+    # ids of the vms waiting in the warm pools in VM_POOL_DIR, see
+    # VMPool.publish()
+    def pooledIds(self):
+        ids = set()
+        if not self.config.VM_POOL_DIR or not os.path.isdir(self.config.VM_POOL_DIR):
+            return ids
+        for d in os.listdir(self.config.VM_POOL_DIR):
+            path = os.path.join(self.config.VM_POOL_DIR, d)
+            if not os.path.isdir(path):
+                continue
+            for f in os.listdir(path):
+                if f.endswith(".json") and not f.startswith("."):
+                    ids.add(f[:-len(".json")].split("_", 1)[-1])
+        return ids
+
+    # Find and remove vms and groups made by the grader which are too old
+    # to belong to a running job.  A pool vm is left alone as long as it
+    # is waiting in the pool, and a packed host as long as it belongs to
+    # the live packer, however old.
+    def sweep(self):
+        now = time.time()
+        stale = []
+        pooled = self.pooledIds()
+        packed = self.packer.hostIds() if self.packer else set()
+        paginator = self.client.get_paginator("describe_instances")
+        for page in paginator.paginate(Filters=[
+                {"Name": "tag:Name", "Values": ["vm_*", "keep-*", "pool_*", "pack_*", "bake_*"]},
+                {"Name": "instance-state-name",
+                 "Values": ["pending", "running", "stopping", "stopped"]}]):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    name = [t["Value"] for t in instance.get("Tags", []) if t["Key"] == "Name"][0]
+                    if name.startswith("pool_") and instance["InstanceId"] in pooled:
+                        continue
+                    if name.startswith("pack_") and instance["InstanceId"] in packed:
+                        continue
+                    maxAge = self.config.REAPER_KEEP_MAX_AGE if name.startswith("keep-") \
+                        else self.config.REAPER_MAX_AGE
+                    age = now - instance["LaunchTime"].timestamp()
+                    if maxAge > 0 and age > maxAge:
+                        self.log.warning("stray vm %s %s, launched %ds ago" %
+                                         (name, instance["InstanceId"], age))
+                        stale.append(instance["InstanceId"])
+        if stale:
+            self.log.info("terminated %d stray instances" % len(self.terminate(stale)))
+
+        # per-job group names end with their creation time, see Grader.run()
+        if self.config.REAPER_MAX_AGE <= 0:
+            return
+        response = self.client.describe_security_groups(
+            Filters=[{"Name": "group-name", "Values": ["secGroup_*"]}])
+        for group in response["SecurityGroups"]:
+            try:
+                created = time.mktime(time.strptime(group["GroupName"].rsplit("_", 1)[-1],
+                                                    "%Y-%m-%dT%H-%M-%S"))
+            except ValueError:
+                continue
+            if now - created > self.config.REAPER_MAX_AGE:
+                self.log.warning("stray sec group %s %s" % (group["GroupName"], group["GroupId"]))
+                self.deleteSecurityGroup(group["GroupId"])
+
+    def manage(self):
+        self.log.info("reaping %s every %ss" % (self.dir, self.config.REAPER_INTERVAL))
+        while not self.stopping:
+            try:
+                self.reap()
+                if time.time() - self.lastSweepTime >= self.config.REAPER_SWEEP_INTERVAL:
+                    self.lastSweepTime = time.time()
+                    self.sweep()
+            except Exception as e:
+                self.log.error("reaper round failed: %s" % e)
+            time.sleep(self.config.REAPER_INTERVAL)
+
+    @staticmethod
+    def main():
+        prober = Grader(forJob=False)
+        if not config.REAPER_DIR:
+            prober.log.error("REAPER_DIR is not set")
+            exit(-1)
+        Reaper(config, Ec2.sharedClient(config)).manage()
+# end of class Reaper
+
+# Aggregate of the jobs' metrics records in METRICS_DIR ("grader.py
+# --metrics"), see Grader.writeMetrics().  The p50/p95/p99 of the job and
+# phase times and of the jobs' resource usage over the last METRICS_WINDOW
+# seconds are written to <METRICS_DIR>/grader.prom, in the Prometheus text
+# format for node_exporter's textfile collector, and the jobs' timing
+# profiles per assignment to <METRICS_DIR>/profiles.json.  Records older
+# than METRICS_RETENTION seconds are deleted.
+class MetricsReport():
+    QUANTILES = (0.5, 0.95, 0.99)
+    # output lines per assignment in profiles.json
+    _PROFILE_LINES = 10
+
+    def __init__(self, config):
+        self.config = config
+        self.dir = config.METRICS_DIR
+        self.log = logging.getLogger("GraderMetrics")
+        self.log.setLevel(logging.DEBUG)
 
-        # set timezone for logging
-        os.environ["TZ"] = config.TIMEZONE
-        time.tzset()
+    # nearest-rank percentile of sorted values
+    @staticmethod
+    def percentile(values, q):
+        return values[max(int(math.ceil(q * len(values))) - 1, 0)]
+
+    def readRecords(self):
+        now = time.time()
+        records = []
+        for f in os.listdir(self.dir):
+            if f.startswith(".") or not f.endswith(".json"):
+                continue
+            path = os.path.join(self.dir, f)
+            try:
+                with open(path, "r") as fp:
+                    record = json.load(fp)
+            except (OSError, ValueError) as e:
+                self.log.error("bad metrics record %s: %s" % (f, e))
+                continue
+            # not a job's record, e.g. profiles.json
+            if not isinstance(record, dict) or "start" not in record:
+                continue
+            age = now - record["start"]
+            if age > self.config.METRICS_RETENTION:
+                os.remove(path)
+            elif age <= self.config.METRICS_WINDOW:
+                records.append(record)
+        return records
+
+    # one Prometheus summary: name{labels,quantile=q} lines, _sum and _count
+    def summary(self, lines, name, helpText, series):
+        lines.append("# HELP %s %s" % (name, helpText))
+        lines.append("# TYPE %s summary" % name)
+        for labels, values in sorted(series.items()):
+            values = sorted(values)
+            for q in self.QUANTILES:
+                lines.append("%s{%squantile=\"%s\"} %.6g" %
+                             (name, labels + "," if labels else "", q, self.percentile(values, q)))
+            braces = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %.6g" % (name, braces, sum(values)))
+            lines.append("%s_count%s %d" % (name, braces, len(values)))
+
+    def write(self):
+        records = self.readRecords()
+        jobs = {}
+        phases = {}
+        resources = {}
+        launches = 0
+        hedges = []
+        saved = {}
+        api = {"calls": 0, "throttles": 0}
+        apiWaits = {}
+        for r in records:
+            # EC2 API calls, see ApiLimiter
+            if r.get("api"):
+                api["calls"] += r["api"]["calls"]
+                api["throttles"] += r["api"]["throttles"]
+                apiWaits.setdefault("", []).append(r["api"]["wait_seconds"])
+            # hedged launches, see Grader.hedgedLaunch()
+            if r.get("hedge"):
+                launches += 1
+                if r["hedge"]["hedged"]:
+                    hedges.append(r["hedge"])
+                if r["hedge"]["saved_seconds"] is not None:
+                    saved.setdefault("", []).append(r["hedge"]["saved_seconds"])
+            jobs.setdefault('result="%s"' % ("success" if r["success"] else "failure"),
+                            []).append(r["seconds"])
+            for name, phase in r["phases"].items():
+                phases.setdefault('phase="%s"' % name, []).append(phase["seconds"])
+            for name, value in r["resources"].items():
+                resources.setdefault('resource="%s"' % name, []).append(value)
+
+        lines = []
+        self.summary(lines, "grader_job_seconds",
+                     "Wall time of grading jobs over the last %ds" % self.config.METRICS_WINDOW, jobs)
+        self.summary(lines, "grader_phase_seconds",
+                     "Wall time of the phases of grading jobs", phases)
+        self.summary(lines, "grader_job_resource",
+                     "Resource usage of grading jobs on the vm, from /usr/bin/time", resources)
+        if launches:
+            lines.append("# HELP grader_hedge_ratio Share of hedged vm launches which launched "
+                         "a second vm")
+            lines.append("# TYPE grader_hedge_ratio gauge")
+            lines.append("grader_hedge_ratio %.6g" % (len(hedges) / launches))
+            lines.append("# HELP grader_hedge_wins Hedged launches won by the second vm")
+            lines.append("# TYPE grader_hedge_wins gauge")
+            lines.append("grader_hedge_wins %d" %
+                         len([h for h in hedges if h["winner"] == "hedge"]))
+            self.summary(lines, "grader_hedge_saved_seconds",
+                         "Estimated launch time saved by hedged launches won by the second vm",
+                         saved)
+        if apiWaits:
+            lines.append("# HELP grader_api_calls EC2 API calls of the jobs")
+            lines.append("# TYPE grader_api_calls gauge")
+            lines.append("grader_api_calls %d" % api["calls"])
+            lines.append("# HELP grader_api_throttles EC2 API calls of the jobs throttled by EC2")
+            lines.append("# TYPE grader_api_throttles gauge")
+            lines.append("grader_api_throttles %d" % api["throttles"])
+            self.summary(lines, "grader_api_wait_seconds",
+                         "Time a job waited for the EC2 API rate limit and throttling backoff",
+                         apiWaits)
+
+        self.writeFile("grader.prom", "\n".join(lines) + "\n")
+        self.log.info("metrics of %d jobs written to %s" %
+                      (len(records), os.path.join(self.dir, "grader.prom")))
+        self.writeProfiles(records)
+
+    # Per assignment, from the jobs' timing profiles (see TimingProfile):
+    # the run time of the jobs, the stalled ones, and the output lines
+    # (tests) which took the most time over all the jobs
+    def writeProfiles(self, records):
+        assignments = {}
+        for r in records:
+            if r.get("profile"):
+                assignments.setdefault(r["assignment"], []).append(r)
+
+        profiles = {}
+        for assignment, jobs in sorted(assignments.items()):
+            lines = {}
+            for r in jobs:
+                for segment in r["profile"]["slowest"]:
+                    lines.setdefault(segment["line"], []).append(segment["seconds"])
+            durations = sorted(r["profile"]["duration"] for r in jobs
+                               if r["profile"]["duration"] is not None)
+            profiles[assignment] = {
+                "jobs": len(jobs),
+                "run_seconds": {str(q): self.percentile(durations, q)
+                                for q in self.QUANTILES} if durations else {},
+                "stalled": [r["submission_id"] for r in jobs if r["profile"]["stalled"]],
+                "slowest_lines": [{"line": line,
+                                   "jobs": len(seconds),
+                                   "seconds": sum(seconds),
+                                   "median_seconds": self.percentile(sorted(seconds), 0.5)}
+                                  for line, seconds in sorted(lines.items(),
+                                                              key=lambda item: -sum(item[1]))
+                                  [:self._PROFILE_LINES]]}
+        self.writeFile("profiles.json", json.dumps(profiles, indent=1))
+        self.log.info("timing profiles of %d assignments written to %s" %
+                      (len(profiles), os.path.join(self.dir, "profiles.json")))
+
+    # replace the file name in METRICS_DIR, never rewriting it in place
+    def writeFile(self, name, text):
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, os.path.join(self.dir, name))
+
+    @staticmethod
+    def main():
+        prober = Grader(forJob=False)
+        if not config.METRICS_DIR:
+            prober.log.error("METRICS_DIR is not set")
+            exit(-1)
+        MetricsReport(config).write()
+# end of class MetricsReport
 
-        self.logfile = os.path.join(config.passedInDir, "grader.log")
+class Grader():
+    _SECURITY_KEY_PATH_INDEX_IN_SSH_FLAGS = 1
+    _CMD_TIMES_SIZE = 1000  # a long running prober keeps only its latest commands
+
+    # A standalone job (the default) uses the passedInDir of
+    # config_defaults.yaml, becomes the process config and logs to
+    # grader.log there.  A job of the grading service names its own
+    # passedInDir and jobName, reads the service's config files first and
+    # logs to grader.log in its own directory under the logger <jobName>,
+    # which names the service's worker slot and is reused by later jobs.
+    # A vm pool manager (forJob=False) needs no job config.
+    # A job of the grading service may be packed with others onto a shared
+    # vm by packer, see VMPacker.
+    def __init__(self, passedInDir=None, forJob=True, baseConfigFiles=(), jobName=None,
+                 packer=None):
+        # errors are stored before logging is ready
+        self.config, error = loadConfig(passedInDir, baseConfigFiles, forJob)
+
+        self.logfile = os.path.join(self.config.passedInDir, "grader.log")
         # empty log file instead of "rm".  Make it easy to watch with "tail -f"
         if os.path.exists(self.logfile):
             open(self.logfile, 'w').close()
-        logging.basicConfig(
-            filename=self.logfile,
-            format="%(levelname)s|%(name)s|%(asctime)s|%(message)s")
-        self.log = logging.getLogger("Grader")
+        self.logHandler = None
+        if jobName is None:
+            global config
+            config = self.config
+
+            # set timezone for logging
+            os.environ["TZ"] = config.TIMEZONE
+            time.tzset()
+
+            logging.basicConfig(
+                filename=self.logfile,
+                format="%(levelname)s|%(name)s|%(asctime)s|%(message)s")
+            logPrefix = ""
+        else:
+            self.logHandler = logging.FileHandler(self.logfile)
+            self.logHandler.setFormatter(logging.Formatter(
+                "%(levelname)s|%(name)s|%(asctime)s|%(message)s"))
+            jobLog = logging.getLogger(jobName)
+            jobLog.addHandler(self.logHandler)
+            jobLog.propagate = False
+            logPrefix = jobName + "."
+        self.logPrefix = logPrefix
+        self.log = logging.getLogger(logPrefix + "Grader")
         self.log.setLevel(logging.DEBUG)
 
         # chicken and egg problem.  When config parsing has errors, the
@@ -311,155 +1935,807 @@ class Grader():
         for e in error:
             self.log.error(e)
         if error:
+            self.closeLog()
             exit(-1)
 
+        self.ssh_flags = ["-i", self.config.SECURITY_KEY_PATH,
+                          "-o", "StrictHostKeyChecking no",
+                          "-o", "GSSAPIAuthentication no"]
+        self.vmUser = self.config.AUTODRIVER_USER_NAME
+
+        # the job's vm and cloud connection, see run()
+        self.vm = None
+        self.cloudConnector = None
+
+        # the shared vm and the slot on it of a packed job, see VMPacker.
+        # The slot decides the grading user and the directory on the vm.
+        self.packer = packer
+        self.host = None
+        self.slot = None
+        self.gradingUser = "autograde"
+
+        # directory of the shared ssh connection's socket, see openMaster()
+        self.controlDir = None
+
+        # the vms of a hedged launch, see hedgedLaunch()
+        self.hedgeVMs = []
+        self.hedgeLock = threading.Lock()
+        self.droppedIds = set()
+
+        # [(command, seconds, return code)] of the latest cmdWithTimeout() calls
+        self.cmdTimes = collections.deque(maxlen=self._CMD_TIMES_SIZE)
+
+        # [(phase name, seconds)] in the order the phases finish, and the
+        # time each phase started
+        self.phaseTimes = []
+        self.phaseStarts = {}
+        self.jobStartTime = time.time()
+
+        if not forJob:
+            return
+
         # output files
-        self.output = os.path.join(config.passedInDir, "output")
-        self.tmpOutput = os.path.join(config.passedInDir, "tmpOutput")
+        self.output = os.path.join(self.config.passedInDir, "output")
+        self.tmpOutput = os.path.join(self.config.passedInDir, "tmpOutput")
         if os.path.exists(self.output):
             os.remove(self.output)
+        # output is written through outputFile, see OutputAssembler
+        self.outputFile = OutputAssembler(self.output, self.config.MAX_GRADER_OUTPUT_SIZE)
         if os.path.exists(self.tmpOutput):
             os.remove(self.tmpOutput)
 
+        # whether autodriver's output came back with the job, see runJobStreaming()
+        self.streamedOutput = False
+        self.copyout_errors = 0
+
+        # copy-in cache hits/misses on the vm, see cachedBundle()
+        self.copyInCache = None
+
+        # the copy-in bundle prepared while the vm boots, see prepareBundle()
+        self.bundle = None
+
+        # numbers for metrics.json, see writeMetrics()
+        self.probeTimes = {}
+        self.copyInStats = {}
+        self.resourceUsage = {}
+        self.ret = {}
+
+        # hit, miss or bypass of the result cache, see ResultCache
+        self.resultCacheStatus = None
+
+        # timing profile from autodriver's timestamps, see TimingProfile
+        self.timingProfile = None
+
+        # numbers of a hedged launch for metrics.json, see hedgedLaunch()
+        self.hedgeStats = None
+
+        # metrics.json has been written, see writeMetrics()
+        self.metricsWritten = False
+
         # assemble the local file and vm file pair for each input file
         self.inputFiles = []
-        for f in config.inputFiles:
-            self.inputFiles.append([os.path.join(config.passedInDir, f["src"]), f["dest"]])
+        for f in self.config.inputFiles:
+            self.inputFiles.append([os.path.join(self.config.passedInDir, f["src"]), f["dest"]])
 
-        self.ssh_flags = ["-i", config.SECURITY_KEY_PATH,
-                          "-o", "StrictHostKeyChecking no",
-                          "-o", "GSSAPIAuthentication no"]
-        self.vmUser = config.AUTODRIVER_USER_NAME
+        # the input files already on the vm's baked image, see findImage()
+        self.bakedFiles = []
     # end of Grade. __init__()
 
-    def cmdWithTimeout(self, command, time_out):
+    # the input files named in BAKE_FILES, as [local path, dest] pairs
+    def bakeFiles(self):
+        return [pair for pair in self.inputFiles if pair[1] in self.config.BAKE_FILES]
+
+    # Find the image for a new vm.  If there is an image baked with the
+    # BAKE_FILES input files, use it and don't copy those files in.
+    def findImage(self):
+        self.cloudConnector.findImage(self.bakeFiles())
+        if self.cloudConnector.baked:
+            self.bakedFiles = self.bakeFiles()
+            self.inputFiles = [pair for pair in self.inputFiles if pair not in self.bakedFiles]
+            self.log.info("image %s has %d of the input files baked in" %
+                          (self.cloudConnector.imageId, len(self.bakedFiles)))
+
+    # the vm's commands which copy the baked input files from BAKE_DIR into
+    # the fresh directory workDir
+    def bakedCopyCmds(self, workDir):
+        cmds = []
+        for pair in self.bakedFiles:
+            if os.path.dirname(pair[1]):
+                cmds.append("mkdir -p %s/%s" % (workDir, shlex.quote(os.path.dirname(pair[1]))))
+            cmds.append("cp %s/%s %s/%s" % (shlex.quote(self.config.BAKE_DIR), shlex.quote(pair[1]),
+                                            workDir, shlex.quote(pair[1])))
+        return cmds
+
+    # Run command and return its return code, or -1 on timeout.  Return as
+    # soon as the command exits.  The command runs in its own process
+    # group, which is killed as a whole on timeout.  The last
+    # CMD_STDERR_TAIL_SIZE bytes of its stderr are logged when it fails, and
+    # its wall time is kept in self.cmdTimes.
+    def cmdWithTimeout(self, command, time_out, stdout=subprocess.DEVNULL):
         self.log.debug("executing cmd: %s" % command)
+        start_time = time.time()
         p = subprocess.Popen(command,
-                             stdout=open("/dev/null", 'w'),
-                             stderr=subprocess.STDOUT)
-
-        # Wait for the command to complete
-        t = 0.0
-        while t < time_out and p.poll() is None:
-            time.sleep(config.TIMER_POLL_INTERVAL)
-            t += config.TIMER_POLL_INTERVAL
+                             stdin=subprocess.DEVNULL,
+                             stdout=stdout,
+                             stderr=subprocess.PIPE,
+                             start_new_session=True)
+
+        # keep only the tail of stderr.  The reader reads the raw fd and
+        # closes the pipe itself, so that nothing waits for it to finish.
+        stderrTail = [b""]
+        def readStderr():
+            try:
+                for chunk in iter(lambda: os.read(p.stderr.fileno(), 4096), b""):
+                    stderrTail[0] = (stderrTail[0] + chunk)[-self.config.CMD_STDERR_TAIL_SIZE:]
+            finally:
+                p.stderr.close()
+        reader = threading.Thread(target=readStderr, daemon=True)
+        reader.start()
 
-        # Determine why the while loop terminated
-        if p.poll() is None:
+        try:
+            returncode = p.wait(timeout=max(time_out, 0))
+        except subprocess.TimeoutExpired:
             try:
-                os.kill(p.pid, 9)
+                os.killpg(p.pid, signal.SIGKILL)
             except OSError:
                 pass
+            p.wait()
             returncode = -1
-        else:
-            returncode = p.poll()
-
-        self.log.debug("executing cmd: return code %s" % returncode)
+        # children which outlive the command may hold stderr open; leave
+        # the pipe to the reader then
+        reader.join(1)
+
+        elapsed = time.time() - start_time
+        self.cmdTimes.append((command[0], elapsed, returncode))
+        self.log.debug("executing cmd: return code %s after %.2f seconds" % (returncode, elapsed))
+        if returncode != 0 and stderrTail[0]:
+            self.log.debug("executing cmd: stderr tail: %s" %
+                           stderrTail[0].decode("utf-8", errors="backslashreplace").strip())
         return returncode
 
-    # simply exit on timeout
-    def waitVM(self):
-        instance_down = 1
+    # Is sshd on the vm accepting connections?  Connect to port 22 and
+    # read the SSH banner, in process.
+    def sshBannerReady(self, ip, timeout):
+        try:
+            with socket.create_connection((ip, 22), timeout=timeout) as sock:
+                banner = sock.recv(256)
+            return banner.startswith(b"SSH-")
+        except OSError:
+            return False
+
+    # Return True when the vm accepts an authenticated ssh command, False
+    # on timeout.  Probes are sub-second apart, growing from
+    # WAITVM_PROBE_MIN_INTERVAL to WAITVM_PROBE_MAX_INTERVAL.
+    # With keepConnection, the authenticated ssh check is the opening of
+    # the shared connection (see openMaster()).
+    def probeVM(self, vm, keepConnection=False):
         start_time = time.time()
+        delay = self.config.WAITVM_PROBE_MIN_INTERVAL
+
+        # seconds until ping/ssh banner/ssh command worked, for the metrics
+        probeTimes = {"ping": None, "banner": None, "ssh": None, "attempts": 0}
+        self.probeTimes = vm.probe_times = probeTimes
 
         self.log.info("WaitVM: wait for VM to be ready")
-        # First, wait for ping to the vm instance to work
+        # Optionally wait for ping to the vm instance to work first.
+        # Many VPCs block ICMP, and the ssh probe doesn't need it.
+        instance_down = 1 if self.config.WAITVM_PING else 0
         while instance_down:
             self.log.debug("ping vm at %s" % vm.public_ip)
-            instance_down = subprocess.call("ping -c 1 %s" % vm.public_ip,
-                                            shell=True,
-                                            stdout=open('/dev/null', 'w'),
+            instance_down = subprocess.call(["ping", "-c", "1", "-W", "1", vm.public_ip],
+                                            stdout=subprocess.DEVNULL,
                                             stderr=subprocess.STDOUT)
 
             # Wait a bit and try again if we haven't exceeded timeout
             if instance_down:
-                time.sleep(config.TIMER_POLL_INTERVAL)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.config.WAITVM_PROBE_MAX_INTERVAL)
                 elapsed_secs = time.time() - start_time
-                if (elapsed_secs > config.WAITVM_TIMEOUT):
+                if (elapsed_secs > self.config.WAITVM_TIMEOUT):
                     self.log.warning("WAITVM: timeout after %s seconds" % elapsed_secs)
-                    exit(-1)
+                    return False
+        if self.config.WAITVM_PING:
+            probeTimes["ping"] = time.time() - start_time
+            self.log.debug("VM ping completed after %.2f seconds" % (time.time() - start_time))
 
-        # The ping worked, so now wait for SSH to work before
-        # declaring that the VM is ready
-        self.log.debug("VM ping completed")
+        # Wait for sshd to send its banner, then for one ssh command to
+        # work before declaring that the VM is ready
         while(True):
             elapsed_secs = time.time() - start_time
 
             # Give up if the elapsed time exceeds the allowable time
-            if elapsed_secs > config.WAITVM_TIMEOUT:
+            if vm.dropped:
+                return False
+            if elapsed_secs > self.config.WAITVM_TIMEOUT:
                 self.log.warning("ssh probe timeout after %d secs" % elapsed_secs)
-                exit(-1)
+                return False
+
+            if self.sshBannerReady(vm.public_ip, min(self.config.WAITVM_TIMEOUT - elapsed_secs, 2)):
+                # If ssh returns neither timeout (-1) nor ssh error
+                # (255), then success. Otherwise, keep trying until we run
+                # out of time.
+                if probeTimes["banner"] is None:
+                    probeTimes["banner"] = time.time() - start_time
+                self.log.debug("ssh banner received after %.2f seconds. send ssh probe to vm" %
+                               (time.time() - start_time))
+                probeTimes["attempts"] += 1
+                timeout = max(self.config.WAITVM_TIMEOUT - elapsed_secs, 1)
+                if keepConnection:
+                    ret = self.openMaster(vm, timeout)
+                else:
+                    ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
+                                              ["-o", "BatchMode yes",
+                                               "%s@%s" % (self.vmUser, vm.public_ip), "(:)"],
+                                              timeout)
+
+                if (ret != -1) and (ret != 255):
+                    probeTimes["ssh"] = time.time() - start_time
+                    self.log.info("WaitVM return normal after %.2f seconds" %
+                                  (time.time() - start_time))
+                    return True
 
-            # If ssh returns neither timeout (-1) nor ssh error
-            # (255), then success. Otherwise, keep trying until we run
-            # out of time.
-            self.log.debug("send ssh probe to vm")
-            ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
-                          ["%s@%s" % (self.vmUser, vm.public_ip),
-                           "(:)"], config.WAITVM_TIMEOUT - elapsed_secs)
+            # Sleep a bit before trying again
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.config.WAITVM_PROBE_MAX_INTERVAL)
+    # end of Grader.probeVM()
 
-            if (ret != -1) and (ret != 255):
-                self.log.info("WaitVM return normal after %s seconds" % elapsed_secs)
+    # simply exit on timeout
+    def waitVM(self, vm):
+        if not self.probeVM(vm, keepConnection=self.config.SSH_MULTIPLEX):
+            exit(-1)
+
+    # Launch vm and wait for it to accept ssh, as initializeVM() and
+    # waitVM() do.  If it isn't ready after the HEDGE_PERCENTILE of recent
+    # launch times (see LaunchHistory), or has failed, launch a second vm,
+    # in HEDGE_SUBNET and of HEDGE_INST_TYPE if set.  The first one ready
+    # becomes the job's vm and the other one is terminated.  Exit when
+    # neither gets ready.
+    def hedgedLaunch(self, vm):
+        history = LaunchHistory(self.config, self.log)
+        delay = history.hedgeDelay(vm.instance_type)
+        cond = threading.Condition()
+        finished = {}  # vm -> (seconds since the start of the launch, ready)
+        result = {"winner": None}
+        start = time.time()
+
+        def attempt(v):
+            t = time.time()
+            try:
+                self.cloudConnector.createVM(v)
+                ready = self.probeVM(v)
+            except Exception as e:
+                self.log.error("launch of %s failed: %s" % (v.configStr(), e))
+                ready = False
+            if ready:
+                history.record(v.instance_type, time.time() - t)
+            with cond:
+                finished[v] = (time.time() - start, ready)
+                if ready and result["winner"] is None:
+                    result["winner"] = v
+                keep = result["winner"] is v
+                cond.notify_all()
+            if not keep:
+                self.dropVM(v)
+
+        def launch(v):
+            self.hedgeVMs.append(v)
+            threading.Thread(target=attempt, args=(v,), name="launch-" + v.name,
+                             daemon=True).start()
+
+        launch(vm)
+        with cond:
+            cond.wait_for(lambda: vm in finished, delay)
+            hedged = result["winner"] is None
+        if hedged:
+            hedge = VM(vm.image_tag, self.config.HEDGE_INST_TYPE or vm.instance_type,
+                       vm.name + "_hedge")
+            hedge.subnet_id = self.config.HEDGE_SUBNET or None
+            self.log.info("vm %s not ready after %.2fs, launching %s" %
+                          (vm, time.time() - start, hedge.configStr()))
+            launch(hedge)
+        with cond:
+            cond.wait_for(lambda: result["winner"] or len(finished) == len(self.hedgeVMs))
+            winner = result["winner"]
+            primarySecs, primaryReady = finished.get(vm, (time.time() - start, None))
+            readySecs = finished[winner][0] if winner else None
+        for v in self.hedgeVMs:
+            if v is not winner:
+                self.dropVM(v)
+
+        # Time saved by a winning hedge.  A first vm still launching would
+        # have been ready as late as the median of the recent launches
+        # slower than it so far.  A failed one would have cost the job its
+        # timeouts, as would one slower than all recent launches.
+        saved = None
+        if winner and winner is not vm:
+            if primaryReady:
+                firstReady = primarySecs
+            else:
+                slower = [] if primaryReady is False else \
+                    [t for t in history.times(vm.instance_type) if t > primarySecs]
+                firstReady = MetricsReport.percentile(slower, 0.5) if slower else \
+                    self.config.INITIALIZEVM_TIMEOUT + self.config.WAITVM_TIMEOUT
+            saved = max(firstReady - readySecs, 0)
+        self.hedgeStats = {"delay": delay,
+                           "hedged": hedged,
+                           "winner": None if winner is None else
+                                     "first" if winner is vm else "hedge",
+                           "first_seconds": primarySecs,
+                           "ready_seconds": readySecs,
+                           "saved_seconds": saved}
+        self.log.info("hedged launch: %s" % self.hedgeStats)
+        if winner is None:
+            exit(-1)
+
+        self.vm = winner
+        self.probeTimes = winner.probe_times
+        if self.config.SSH_MULTIPLEX:
+            self.openMaster(winner, self.config.WAITVM_TIMEOUT)
+    # end of Grader.hedgedLaunch()
+
+    # Terminate a vm of a hedged launch which the job doesn't use
+    def dropVM(self, vm):
+        with self.hedgeLock:
+            vm.dropped = True
+            if vm.instance_id is None or vm.instance_id in self.droppedIds:
                 return
+            self.droppedIds.add(vm.instance_id)
+        try:
+            self.cloudConnector.terminateVM(vm)
+        except Exception as e:
+            self.log.error("failed to terminate %s: %s" % (vm, e))
+
+    # Open a persistent ssh connection to the vm (ControlMaster) which all
+    # later ssh and scp commands of the job share, saving a handshake per
+    # command.  Return ssh's return code.  If it fails, the commands simply
+    # connect on their own.
+    def openMaster(self, vm, timeout):
+        self.controlDir = tempfile.mkdtemp(prefix="grader-ssh-")
+        controlFlags = ["-o", "ControlPath %s" % os.path.join(self.controlDir, "%C")]
+        # Not cmdWithTimeout(): the master stays in the background with
+        # ssh's stdio, which must not be a pipe we wait on.
+        try:
+            # -f: go to background once authenticated
+            ret = subprocess.call(["ssh"] + self.ssh_flags + controlFlags +
+                                  ["-o", "ControlMaster yes",
+                                   "-o", "ControlPersist yes",
+                                   "-o", "ServerAliveInterval 15",
+                                   "-o", "BatchMode yes",
+                                   "-N", "-f", "%s@%s" % (self.vmUser, vm.public_ip)],
+                                  stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL,
+                                  timeout=timeout)
+        except subprocess.TimeoutExpired:
+            ret = -1
+
+        if ret == 0:
+            self.log.info("shared ssh connection to %s opened" % vm.public_ip)
+            self.ssh_flags = self.ssh_flags + controlFlags + ["-o", "ControlMaster no"]
+        else:
+            shutil.rmtree(self.controlDir, ignore_errors=True)
+            self.controlDir = None
+        return ret
 
-            # Sleep a bit before trying again
-            time.sleep(config.TIMER_POLL_INTERVAL)
-    # end of Grader.WaitVM()
+    def closeMaster(self, vm):
+        if self.controlDir is None:
+            return
+        try:
+            subprocess.call(["ssh"] + self.ssh_flags +
+                            ["-O", "exit", "%s@%s" % (self.vmUser, vm.public_ip)],
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            timeout=10)
+        except subprocess.TimeoutExpired:
+            self.log.warning("timeout closing shared ssh connection")
+        shutil.rmtree(self.controlDir, ignore_errors=True)
+        self.controlDir = None
+
+    # Record how long a phase took since start_time.  Return the current time.
+    def recordPhase(self, name, start_time):
+        now = time.time()
+        self.phaseTimes.append((name, now - start_time))
+        self.phaseStarts[name] = start_time
+        self.log.debug("phase %s took %.2f seconds" % (name, now - start_time))
+        return now
 
     # simply exit on error
     def copyIn(self):
+        if self.config.COPYIN_MODE == "bundle":
+            return self.copyInBundle()
+
         # Create a fresh input directory
-        ret = subprocess.call(["ssh"] + self.ssh_flags +
-                              ["%s@%s" % (self.vmUser, vm.public_ip),
-                               "(rm -rf autolab; mkdir autolab)"])
+        workDir = self.remotePath("autolab")
+        ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
+                                  ["%s@%s" % (self.vmUser, self.vm.public_ip),
+                                   " && ".join(["(rm -rf {0}; mkdir -p {0})".format(workDir)] +
+                                               self.bakedCopyCmds(workDir))],
+                                  self.config.COPYIN_TIMEOUT)
+        if ret != 0 and self.bakedFiles:
+            self.log.error("failed to copy the baked files. exit")
+            exit(-1)
 
         # Copy the input files to the input directory
+        self.copyInStats = {"mode": "scp", "files": [],
+                            "baked": [pair[1] for pair in self.bakedFiles]}
         for pair in self.inputFiles:
             self.log.info("copy to vm: %s as %s" % (pair[0], pair[1]))
+            # timed here: other phases' commands may run meanwhile
+            start = time.time()
             ret = self.cmdWithTimeout(["scp"] +
                                self.ssh_flags +
-                               [pair[0], "%s@%s:autolab/%s" %
-                                (self.vmUser, vm.public_ip, pair[1])],
-                               config.COPYIN_TIMEOUT)
+                               [pair[0], "%s@%s:%s/%s" %
+                                (self.vmUser, self.vm.public_ip, self.remotePath("autolab"), pair[1])],
+                               self.config.COPYIN_TIMEOUT)
+            self.copyInStats["files"].append({"name": pair[1],
+                                              "bytes": os.path.getsize(pair[0]),
+                                              "seconds": time.time() - start})
             if ret != 0:
                 self.log.error("copy failed. exit")
                 exit(-1)
 
+    # magic numbers of files that don't compress any further
+    _COMPRESSED_MAGIC = (b"\x1f\x8b",              # gzip
+                         b"BZh",                   # bzip2
+                         b"\xfd7zXZ\x00",          # xz
+                         b"\x28\xb5\x2f\xfd",      # zstd
+                         b"PK\x03\x04",            # zip
+                         b"7z\xbc\xaf\x27\x1c")    # 7z
+
+    # local compressor and the vm's decompressor for the copy-in bundle
+    _COMPRESSORS = {"gzip": (["gzip", "-c"], "gzip -dc"),
+                    "zstd": (["zstd", "-c", "-q", "-T0"], "zstd -dc")}
+
+    # COPYIN_COMPRESSION, unless most input bytes are already compressed
+    def bundleCompression(self):
+        if self.config.COPYIN_COMPRESSION not in self._COMPRESSORS:
+            return "none"
+        compressedBytes = totalBytes = 0
+        for pair in self.inputFiles:
+            size = os.path.getsize(pair[0])
+            with open(pair[0], "rb") as f:
+                if f.read(6).startswith(self._COMPRESSED_MAGIC):
+                    compressedBytes += size
+            totalBytes += size
+        if compressedBytes * 2 > totalBytes:
+            self.log.info("%d of %d input bytes already compressed. bundle without compression" %
+                          (compressedBytes, totalBytes))
+            return "none"
+        return self.config.COPYIN_COMPRESSION
+
+    # the vm's command which unpacks the bundle from stdin into directory
+    def unpackCmd(self, compression, directory):
+        unpack = "tar -x -C %s -f -" % directory
+        if compression != "none":
+            unpack = "%s | %s" % (self._COMPRESSORS[compression][1], unpack)
+        return unpack
+
+    # The part of copy-in which doesn't need the vm, done while it boots:
+    # pick the compression and either hash the input files for the vm's
+    # cache or build the whole compressed bundle into a local temp file.
+    def prepareBundle(self):
+        self.bundle = types.SimpleNamespace(compression=self.bundleCompression(), file=None)
+        if self.config.COPYIN_CACHE:
+            for pair in self.inputFiles:
+                fileHash(pair[0])  # remembered for cachedBundle()
+            return
+
+        f = tempfile.TemporaryFile()
+        try:
+            self.writeBundle(self.inputFiles, self.bundle.compression, ByteCounter(f), [])
+        except (OSError, ValueError) as e:
+            f.close()
+            self.log.warning("failed to prepare bundle, build it at copy-in: %s" % e)
+            return
+        f.seek(0)
+        self.bundle.file = f
+
+    # Stream all input files, renamed to their dest names, as one tar
+    # stream, compressed on the fly, through one ssh command which unpacks
+    # it into a fresh autolab directory.  Simply exit on error.
+    def copyInBundle(self):
+        if self.bundle is None:
+            self.prepareBundle()
+        compression = self.bundle.compression
+        rawBytes = sum(os.path.getsize(pair[0]) for pair in self.inputFiles)
+        for pair in self.inputFiles:
+            self.log.info("copy to vm: %s as %s" % (pair[0], pair[1]))
+
+        if self.config.COPYIN_CACHE:
+            members, remoteCmd = self.cachedBundle(compression)
+        else:
+            members = self.inputFiles
+            workDir = self.remotePath("autolab")
+            remoteCmd = "rm -rf {0}; mkdir -p {0} && {1}".format(workDir,
+                                                                 self.unpackCmd(compression, workDir))
+            remoteCmd = " && ".join([remoteCmd] + self.bakedCopyCmds(workDir))
+
+        start_time = time.time()
+        try:
+            ret, wireBytes = self.sendBundle(members, remoteCmd, compression, self.bundle.file)
+        finally:
+            if self.bundle.file:
+                self.bundle.file.close()
+        elapsed = max(time.time() - start_time, 0.001)
+        self.log.info("copied %d bytes in %d files as %d bytes (%s, ratio %.2f) in %.2f seconds, %.2f MB/s" %
+                      (rawBytes, len(self.inputFiles), wireBytes, compression,
+                       rawBytes / max(wireBytes, 1), elapsed, rawBytes / elapsed / 1e6))
+        self.copyInStats = {"mode": "bundle",
+                            "compression": compression,
+                            "raw_bytes": rawBytes,
+                            "wire_bytes": wireBytes,
+                            "seconds": elapsed,
+                            "cache": self.copyInCache,
+                            "baked": [pair[1] for pair in self.bakedFiles],
+                            "files": [{"name": pair[1], "bytes": os.path.getsize(pair[0])}
+                                      for pair in self.inputFiles]}
+        if ret != 0:
+            self.log.error("copy failed. return code %s. exit" % ret)
+            exit(-1)
+
+    # The vm keeps the input files it has received in COPYIN_CACHE_DIR,
+    # named by their sha256.  Return the bundle members the vm doesn't
+    # have yet, and the vm's command which adds them to the cache and then
+    # copies all input files from the cache to a fresh autolab directory.
+    def cachedBundle(self, compression):
+        cacheDir = shlex.quote(self.config.COPYIN_CACHE_DIR)
+        hashes = [fileHash(pair[0]) for pair in self.inputFiles]
+
+        # ask the vm which files it has
+        present = set()
+        with tempfile.TemporaryFile() as answer:
+            ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
+                                      ["%s@%s" % (self.vmUser, self.vm.public_ip),
+                                       "mkdir -p %s && cd %s && for h in %s; do [ -f $h ] && echo $h; done; true" %
+                                       (cacheDir, cacheDir, " ".join(hashes))],
+                                      self.config.COPYIN_TIMEOUT, stdout=answer)
+            if ret == 0:
+                answer.seek(0)
+                present = set(answer.read().decode().split())
+            else:
+                self.log.warning("failed to ask vm for cached files. send all")
+
+        members = []
+        workDir = self.remotePath("autolab")
+        materialize = ["rm -rf %s" % workDir, "mkdir -p %s" % workDir]
+        sent = set()
+        hits = 0
+        bytesSaved = 0
+        for pair, h in zip(self.inputFiles, hashes):
+            if h in present:
+                hits += 1
+                bytesSaved += os.path.getsize(pair[0])
+            elif h in sent:
+                bytesSaved += os.path.getsize(pair[0])
+            else:
+                members.append([pair[0], h])
+                sent.add(h)
+            # Copy, not hard link: autodriver chowns the job directory to
+            # the grading user, which would chown the cached file too.
+            if os.path.dirname(pair[1]):
+                materialize.append("mkdir -p %s/%s" % (workDir, shlex.quote(os.path.dirname(pair[1]))))
+            materialize.append("cp %s/%s %s/%s" % (cacheDir, h, workDir, shlex.quote(pair[1])))
+        materialize += self.bakedCopyCmds(workDir)
+
+        self.copyInCache = {"hits": hits,
+                            "misses": len(self.inputFiles) - hits,
+                            "bytes_saved": bytesSaved}
+        self.log.info("copy-in cache on vm: %d hits, %d misses, %d bytes saved" %
+                      (hits, len(self.inputFiles) - hits, bytesSaved))
+
+        # unpack into a temp dir first, so an interrupted copy doesn't
+        # leave partial files under their hash names
+        remoteCmd = ("mkdir -p %s && t=$(mktemp -d %s/incoming.XXXXXX) && %s && "
+                     "(mv -f $t/* %s/ 2>/dev/null; rm -rf $t) && %s" %
+                     (cacheDir, cacheDir, self.unpackCmd(compression, "$t"), cacheDir,
+                      " && ".join(materialize)))
+        return members, remoteCmd
+
+    # Write files [(local path, name in tar)] as one tar stream, compressed
+    # on the fly, to the ByteCounter out.  The compressor is added to procs.
+    def writeBundle(self, members, compression, out, procs):
+        if compression == "none":
+            with tarfile.open(fileobj=out, mode="w|") as tar:
+                for member in members:
+                    tar.add(member[0], arcname=member[1])
+            return
+
+        compressor = subprocess.Popen(self._COMPRESSORS[compression][0],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        procs.append(compressor)
+
+        # compressor output to out, while the tar stream goes in
+        pump = threading.Thread(target=out.copyFrom, args=(compressor.stdout,))
+        pump.start()
+        try:
+            with tarfile.open(fileobj=compressor.stdin, mode="w|") as tar:
+                for member in members:
+                    tar.add(member[0], arcname=member[1])
+        finally:
+            compressor.stdin.close()
+            pump.join()
+        if compressor.wait() != 0 or out.error:
+            raise OSError(out.error or "compressor failed")
+
+    # Stream files [(local path, name in tar)] as one tar stream,
+    # compressed on the fly, to the stdin of remoteCmd on the vm, or send
+    # bundleFile, the same stream prepared before.  Return remoteCmd's
+    # return code (-1 for timeout or error) and bytes sent.
+    def sendBundle(self, members, remoteCmd, compression, bundleFile=None):
+        ssh = subprocess.Popen(["ssh"] + self.ssh_flags +
+                               ["%s@%s" % (self.vmUser, self.vm.public_ip), remoteCmd],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+        wire = ByteCounter(ssh.stdin)
+        procs = [ssh]
+
+        # kill everything if the copy takes too long.  The pending writes
+        # then fail with broken pipe.
+        def kill():
+            self.log.error("copy timeout after %d seconds" % self.config.COPYIN_TIMEOUT)
+            for p in procs:
+                p.kill()
+        timer = threading.Timer(self.config.COPYIN_TIMEOUT, kill)
+        timer.start()
+
+        ret = -1
+        try:
+            if bundleFile:
+                wire.copyFrom(bundleFile)
+                if wire.error:
+                    raise OSError(wire.error)
+            else:
+                self.writeBundle(members, compression, wire, procs)
+            ssh.stdin.close()
+            ret = ssh.wait()
+        except (OSError, ValueError) as e:
+            self.log.error("copy exception: %s" % e)
+        finally:
+            timer.cancel()
+            for p in procs:
+                if p.poll() is None:
+                    p.kill()
+        return ret, wire.count
+
+    # /usr/bin/time's report in time.out on the vm, one name=value per line
+    _TIME_FORMAT = ("elapsed_seconds=%e\\nuser_seconds=%U\\nsystem_seconds=%S\\n"
+                    "max_rss_kb=%M\\nmajor_faults=%F\\nminor_faults=%R\\n"
+                    "fs_inputs=%I\\nfs_outputs=%O\\nvoluntary_switches=%w\\n"
+                    "involuntary_switches=%c\\nexit_status=%x")
+
     # runJob() doesn't exit on error.  It lets the caller decide
     # how to handle error, such as still copying data off the vm.
     def runJob(self):
         self.log.info("Running job on VM")
 
-        runcmd = "/usr/bin/time --output=time.out autodriver \
+        runcmd = "/usr/bin/time --output=%s --format=%s autodriver \
         -u %d -f %d -t %d -o %d " % (
-            config.VM_ULIMIT_USER_PROC,
-            config.VM_ULIMIT_FILE_SIZE,
-            config.RUNJOB_TIMEOUT,
-            config.MAX_OUTPUT_FILE_SIZE)
-        runcmd = runcmd + ("-z %s " % config.TIMEZONE)
-        runcmd = runcmd + ("-i %d " % config.AUTODRIVER_TIMESTAMP_INTERVAL)
-        runcmd = runcmd + "autolab &> output"
+            self.remotePath("time.out"),
+            shlex.quote(self._TIME_FORMAT),
+            self.config.VM_ULIMIT_USER_PROC,
+            self.config.VM_ULIMIT_FILE_SIZE,
+            self.config.RUNJOB_TIMEOUT,
+            self.config.MAX_OUTPUT_FILE_SIZE)
+        runcmd = runcmd + ("-z %s " % self.config.TIMEZONE)
+        runcmd = runcmd + ("-i %d " % self.config.AUTODRIVER_TIMESTAMP_INTERVAL)
+        if self.slot is not None:
+            runcmd = runcmd + ("-g %s " % self.gradingUser)
+        if self.config.RUNJOB_STREAM:
+            return self.runJobStreaming(runcmd + self.remotePath("autolab"))
+        runcmd = runcmd + "%s &> %s" % (self.remotePath("autolab"), self.remotePath("output"))
 
         # timeout * 2 is a conservative estimate.
         # most likely autodriver already returned a timeout error
         ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
-                      ["%s@%s" % (self.vmUser, vm.public_ip), runcmd],
-                                  config.RUNJOB_TIMEOUT * 2)
+                      ["%s@%s" % (self.vmUser, self.vm.public_ip), runcmd],
+                                  self.config.RUNJOB_TIMEOUT * 2)
         return ret
 
+    # autodriver's raw output file in the grading user's home, written
+    # while the job runs
+    _AUTODRIVER_LIVE_OUTPUT = "output.log"
+
+    # Where a file of the job is on the vm, relative to the ssh user's home.
+    # A job packed on a shared vm keeps its files in its slot's directory.
+    def remotePath(self, name):
+        if self.slot is None:
+            return name
+        return "slot%d/%s" % (self.slot, name)
+
+    # Run the job with its output coming back over the ssh session.  While
+    # the job runs, the raw output on the vm is tailed (on ssh's stderr)
+    # into tmpOutput, in chunks and up to MAX_OUTPUT_FILE_SIZE bytes.  When
+    # autodriver exits, its output (with its usual truncation and
+    # timestamps) comes on ssh's stdout and replaces tmpOutput, so there is
+    # nothing left to copy out.  If the session breaks, tmpOutput keeps
+    # what has been seen so far, until copyOut() fetches the output file.
+    def runJobStreaming(self, runcmd):
+        script = ("{0} > {1} 2>&1 & pid=$!; "
+                  "tail -c +1 -F --pid=$pid ~{2}/{3} >&2 2>/dev/null; "
+                  "wait $pid; rc=$?; cat {1}; exit $rc".format(
+                      runcmd, self.remotePath("output"), self.gradingUser,
+                      self._AUTODRIVER_LIVE_OUTPUT))
+        finalOutput = self.tmpOutput + ".final"
+
+        self.log.debug("executing cmd: %s" % script)
+        with open(finalOutput, "wb") as final:
+            p = subprocess.Popen(["ssh", "-q"] + self.ssh_flags +
+                                 ["%s@%s" % (self.vmUser, self.vm.public_ip), script],
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=final,
+                                 stderr=subprocess.PIPE)
+
+        def tail():
+            written = 0
+            with open(self.tmpOutput, "wb") as live:
+                while True:
+                    chunk = p.stderr.read1(ByteCounter.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if written < self.config.MAX_OUTPUT_FILE_SIZE:
+                        chunk = chunk[:self.config.MAX_OUTPUT_FILE_SIZE - written]
+                        live.write(chunk)
+                        live.flush()
+                        written += len(chunk)
+        tailer = threading.Thread(target=tail)
+        tailer.start()
+
+        # timeout * 2 is a conservative estimate.
+        # most likely autodriver already returned a timeout error
+        try:
+            ret = p.wait(timeout=self.config.RUNJOB_TIMEOUT * 2)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+            ret = -1
+        tailer.join()
+
+        if os.path.getsize(finalOutput) > 0:
+            os.replace(finalOutput, self.tmpOutput)
+            self.streamedOutput = True
+        else:
+            os.remove(finalOutput)
+        self.log.debug("executing cmd: return code %s" % ret)
+        return ret
+
+    # Fetch the job's resource usage, written by /usr/bin/time into
+    # time.out on the vm, into self.resourceUsage.  Failure only loses
+    # the numbers.
+    def pullResourceUsage(self):
+        with tempfile.TemporaryFile() as timeOut:
+            ret = self.cmdWithTimeout(["ssh"] + self.ssh_flags +
+                                      ["%s@%s" % (self.vmUser, self.vm.public_ip),
+                                       "cat %s" % self.remotePath("time.out")],
+                                      self.config.COPYOUT_TIMEOUT, stdout=timeOut)
+            if ret != 0:
+                self.log.warning("failed to fetch time.out. return code %s" % ret)
+                return
+            timeOut.seek(0)
+            lines = timeOut.read().decode(errors="replace").splitlines()
+        for line in lines:
+            name, sep, value = line.partition("=")
+            if sep:
+                try:
+                    self.resourceUsage[name] = float(value)
+                except ValueError:
+                    pass
+        self.log.info("job resource usage: %s" %
+                      ", ".join("%s %s" % item for item in self.resourceUsage.items()))
+
     # runJob() doesn't exit on error.  It lets the caller decide
     # how to handle error, such as add grader messages into output file.
     def copyOut(self, vm):
         self.log.info("copy from vm to %s" % self.output)
         return self.cmdWithTimeout(["scp"] + self.ssh_flags +
-                            ["%s@%s:output" % (self.vmUser, vm.public_ip), self.tmpOutput],
-                            config.COPYOUT_TIMEOUT)
+                            ["%s@%s:%s" % (self.vmUser, vm.public_ip, self.remotePath("output")),
+                             self.tmpOutput],
+                            self.config.COPYOUT_TIMEOUT)
 
     # write msg to output file which will be appended with grading vm's output
     def appendMsg(self, msg):
-        f = open(self.output, "a")
-        f.write("Grader Container [%s]: %s\n" % (datetime.now().ctime(), msg))
-        f.close()
+        self.outputFile.message("Grader Container [%s]: %s\n" % (datetime.now().ctime(), msg))
         self.log.info(msg)  # also log it
 
     def afterJob(self, msg):
@@ -468,70 +2744,266 @@ class Grader():
 
         # output from grading may not exist
         if os.path.exists(self.tmpOutput):
+            try:
+                self.timingProfile = TimingProfile.extract(self.tmpOutput,
+                                                           self.config.AUTODRIVER_TIMESTAMP_STRIP,
+                                                           self.config.PROFILE_STALL_SECONDS)
+            except (OSError, ValueError) as err:
+                self.log.warning("failed to read the timestamps in output: %s" % err)
+            if self.timingProfile:
+                slowest = self.timingProfile["slowest"][0]
+                self.log.info("timing profile: %d timestamps, slowest %.0fs before \"%s\"%s" %
+                              (len(self.timingProfile["points"]), slowest["seconds"],
+                               slowest["line"],
+                               ", stalled" if self.timingProfile["stalled"] else ""))
             self.appendMsg("FOUND output of autodriver from grading VM:\n")
             try:
-                with open(self.output, "a",
-                          encoding='utf-8',
-                          errors='backslashreplace') as f1:
-                    # append grading vm's output to output
-                    with open(self.tmpOutput, "r",
-                              encoding="utf-8",
-                              errors='backslashreplace') as f2:
-                        shutil.copyfileobj(f2, f1)
-                    os.remove(self.tmpOutput)  # remove when copying succeeds
+                # append grading vm's output to output
+                if not self.outputFile.append(self.tmpOutput):
+                    self.outputFile.message("\n")
+                    self.appendMsg("output cut at %d bytes (MAX_GRADER_OUTPUT_SIZE)" %
+                                   self.config.MAX_GRADER_OUTPUT_SIZE)
+                os.remove(self.tmpOutput)  # remove when copying succeeds
             except Exception as err:
                 self.appendMsg("exception in appending output: %s" % err)
         else:
             self.appendMsg("NO OUTPUT FILE FROM GRADING VM\n")
 
-        os.chmod(self.output, 0o644)
-        cloudConnector.destroyVM(notes=msg)
+        self.outputFile.finish()
+        t = time.time()
+        self.destroyVM(notes=msg)
+        self.recordPhase("destroy", t)
+        self.log.info("phase times (ssh multiplexing %s): %s" %
+                      ("on" if self.config.SSH_MULTIPLEX else "off",
+                       ", ".join("%s %.2fs" % p for p in self.phaseTimes)))
+        if self.cloudConnector:
+            self.log.info("EC2 API: %(calls)d calls, %(throttles)d throttled, "
+                          "%(wait_seconds).2fs waiting for the rate limit" % self.cloudConnector.apiStats)
+        self.writeMetrics(msg)
+
+    # Write the job's timing and resource numbers as one json record into
+    # metrics.json next to output, and into METRICS_DIR if set, where
+    # "grader.py --metrics" aggregates the records of many jobs.
+    def writeMetrics(self, msg):
+        self.metricsWritten = True
+        vm = self.vm or VM()
+        record = {"submission_id": self.config.SUBMISSION_ID,
+                  "image_tag": self.config.IMAGE_TAG,
+                  "assignment": self.config.ASSIGNMENT or self.config.IMAGE_TAG,
+                  "instance_type": vm.instance_type,
+                  "instance_id": vm.instance_id,
+                  "start": self.jobStartTime,
+                  "seconds": time.time() - self.jobStartTime,
+                  "success": msg.startswith("Success"),
+                  "message": msg,
+                  "runjob_return_code": self.ret.get("runjob"),
+                  "copyout_return_code": self.ret.get("copyout"),
+                  "phases": {name: {"start": self.phaseStarts[name] - self.jobStartTime,
+                                    "seconds": seconds}
+                             for name, seconds in self.phaseTimes},
+                  "state_transitions": vm.state_transitions,
+                  "probe": self.probeTimes,
+                  "copyin": self.copyInStats,
+                  "resources": self.resourceUsage,
+                  "result_cache": self.resultCacheStatus,
+                  "hedge": self.hedgeStats,
+                  "profile": self.timingProfile,
+                  "api": self.cloudConnector.apiStats if self.cloudConnector else None,
+                  "commands": [{"command": c, "seconds": t, "return_code": r}
+                               for c, t, r in self.cmdTimes]}
+        dests = [(self.config.passedInDir, "metrics.json")]
+        if self.config.METRICS_DIR:
+            dests.append((self.config.METRICS_DIR, "%s_%d.json" % (self.config.SUBMISSION_ID,
+                                                                    self.jobStartTime * 1000)))
+        for directory, name in dests:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=directory, prefix=".")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(record, f, indent=1)
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, os.path.join(directory, name))
+            except OSError as e:
+                self.log.error("failed to write metrics into %s: %s" % (directory, e))
+
+    # Close the shared ssh connection and destroy the job's vm and security
+    # group.  Safe to call more than once.
+    def destroyVM(self, notes=None):
+        if self.vm:
+            self.closeMaster(self.vm)
+        for vm in self.hedgeVMs:
+            if vm is not self.vm:
+                self.dropVM(vm)
+        # a shared vm only gets its slot back, once: the slot may be
+        # another job's by the next call
+        if self.slot is not None:
+            if self.host:
+                self.packer.release(self.host, self.slot)
+                self.host = None
+            return
+        if self.cloudConnector:
+            self.cloudConnector.destroyVM(self.vm, notes=notes)
+
+    # stop logging into the job's grader.log, see __init__()
+    def closeLog(self):
+        if self.logHandler:
+            logging.getLogger(self.logPrefix[:-1]).removeHandler(self.logHandler)
+            self.logHandler.close()
+            self.logHandler = None
 
     def run(self):
         """run - Step a job through its execution sequence
         """
+        graph = None
+        msg = ""
         try:
-            ret = {}
+            ret = self.ret
             ret["runjob"] = None
             ret["copyout"] = None
             msg = ""
 
             # Header message for user
-            self.appendMsg("Received job %s" % config.SUBMISSION_ID)
-
-            global cloudConnector
-            cloudConnector = Ec2()
+            self.appendMsg("Received job %s" % self.config.SUBMISSION_ID)
+
+            # an identical job has been graded before
+            resultKey = None
+            if self.config.RESULT_CACHE_DIR:
+                if self.config.RESULT_CACHE_BYPASS:
+                    self.resultCacheStatus = "bypass"
+                else:
+                    resultCache = ResultCache(self.config, self.log)
+                    resultKey = resultCache.key(self.inputFiles)
+                    hit = resultCache.lookup(resultKey)
+                    self.resultCacheStatus = "hit" if hit else "miss"
+                    self.log.info("result cache %s: %s" % (self.resultCacheStatus, resultKey))
+                    if hit:
+                        shutil.copyfile(hit[0], self.tmpOutput)
+                        ret["runjob"] = ret["copyout"] = 0
+                        self.appendMsg("Output of identical job %s graded at %s" %
+                                       (hit[1]["submission_id"], time.ctime(hit[1]["time"])))
+                        self.afterJob("Success: Autodriver returned normally")
+                        return
+
+            self.cloudConnector = Ec2(self.config, self.logPrefix)
+            with activeGradersLock:
+                activeGraders.add(self)
+            cloud = self.cloudConnector
 
             startTime = time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime())
 
-            global vm
-            vm = VM()
-            vm.image_tag = config.IMAGE_TAG
-            vm.name = "vm_%s_%s" % (config.SUBMISSION_ID, startTime)
-            vm.instance_type = config.EC2_INST_TYPE
-
-            global secGroup
-            secGroup = "secGroup_%s_%s" % (config.SUBMISSION_ID, startTime)
-
-            # the call will exit on exception
-            cloudConnector.initializeVM()
-            self.appendMsg("initialized VM %s" % vm)
-
-            # Wait for the instance to be ready. will exit on failure
-            self.waitVM()
-            self.appendMsg("VM is ready")
-
-            # Copy input files to VM. will exit on failure
-            self.copyIn()
-            self.appendMsg("Files copied to VM")
-
-            # Run the job on the virtual machine.
-            ret["runjob"] = self.runJob()
-            self.appendMsg("Job run on VM.  return code %s" % ret["runjob"])
-
-            # Copy the output back, even if runjob has failed
-            ret["copyout"] = self.copyOut(vm)
-            self.appendMsg("after copying from VM. return code %s" % ret["copyout"])
+            # The job's phases and what each needs first.  Independent ones
+            # run at the same time, see PhaseGraph.
+            graph = PhaseGraph(self.log, self.recordPhase)
+
+            # take a ready vm from the warm pool if there is one
+            vm = None
+            t = time.time()
+            if self.config.VM_POOL_DIR and not (self.packer and self.config.PACK_INST_TYPE):
+                vm = VMPool(self.config).claim()
+                # a vm may have been stopped or terminated while in the pool
+                if vm and not self.sshBannerReady(vm.public_ip, self.config.VM_POOL_CLAIM_TIMEOUT):
+                    self.log.warning("pool vm %s doesn't answer. launch a new one" % vm)
+                    try:
+                        cloud.terminateVM(vm)
+                    except Exception as e:
+                        self.log.error("Exception when terminating: %s" % e)
+                    vm = None
+            if self.packer and self.config.PACK_INST_TYPE:
+                def takeSlot():
+                    self.host, self.slot = self.packer.acquire(self.config.JOB_CPUS,
+                                                               self.config.JOB_MEMORY_MB)
+                    self.vm = self.host.vm
+                    self.gradingUser = "%s%d" % (self.config.PACK_USER_PREFIX, self.slot)
+                    self.appendMsg("slot %d of packed VM %s is ready" % (self.slot, self.vm))
+
+                graph.add("slotwait", takeSlot)
+                ready = ["slotwait"]
+                if self.config.SSH_MULTIPLEX:
+                    graph.add("sshconnect",
+                              lambda: self.openMaster(self.vm, self.config.WAITVM_TIMEOUT),
+                              ["slotwait"])
+                    ready = ["sshconnect"]
+            elif vm:
+                self.vm = vm
+                t = self.recordPhase("poolclaim", t)
+                vm.name = "vm_%s_%s" % (self.config.SUBMISSION_ID, startTime)
+                graph.add("tagvm", lambda: cloud.adoptVM(vm))
+                ready = []
+                if self.config.SSH_MULTIPLEX:
+                    graph.add("sshconnect", lambda: self.openMaster(vm, self.config.WAITVM_TIMEOUT))
+                    ready = ["sshconnect"]
+                self.appendMsg("VM %s from pool is ready" % vm)
+            else:
+                vm = VM()
+                self.vm = vm
+                vm.image_tag = self.config.IMAGE_TAG
+                vm.name = "vm_%s_%s" % (self.config.SUBMISSION_ID, startTime)
+                vm.instance_type = self.config.EC2_INST_TYPE
+
+                cloud.secGroup = "secGroup_%s_%s" % (self.config.SUBMISSION_ID, startTime)
+
+                def initializeVM():
+                    # the call will exit on exception
+                    cloud.initializeVM(vm)
+                    self.appendMsg("initialized VM %s" % vm)
+
+                def waitVM():
+                    # Wait for the instance to be ready. will exit on failure
+                    self.waitVM(vm)
+                    LaunchHistory(self.config, self.log).record(
+                        vm.instance_type, time.time() - self.phaseStarts["initializevm"])
+                    self.appendMsg("VM is ready")
+
+                def hedgedLaunch():
+                    # will exit when no vm gets ready
+                    self.hedgedLaunch(vm)
+                    self.appendMsg("VM %s is ready" % self.vm)
+
+                graph.add("image", self.findImage)
+                graph.add("secgroup", cloud.prepareSecurityGroup)
+                if self.config.HEDGE_LAUNCH:
+                    graph.add("hedgedlaunch", hedgedLaunch, ["image", "secgroup"])
+                    ready = ["hedgedlaunch"]
+                else:
+                    graph.add("initializevm", initializeVM, ["image", "secgroup"])
+                    graph.add("waitvm", waitVM, ["initializevm"])
+                    ready = ["waitvm"]
+
+            def copyIn():
+                # Copy input files to VM. will exit on failure
+                self.copyIn()
+                self.appendMsg("Files copied to VM")
+
+            def runJob():
+                # Run the job on the virtual machine.
+                ret["runjob"] = self.runJob()
+                self.appendMsg("Job run on VM.  return code %s" % ret["runjob"])
+
+            def copyOut():
+                # Copy the output back, even if runjob has failed.  Streamed
+                # output is already here, and there is no copy to report.
+                # If the stream broke, the output file on the vm is fetched
+                # as usual.
+                if self.streamedOutput:
+                    ret["copyout"] = 0
+                    return
+                ret["copyout"] = self.copyOut(self.vm)
+                self.appendMsg("after copying from VM. return code %s" % ret["copyout"])
+
+            # the input bundle is built while the vm boots, but without the
+            # files which the image turns out to have
+            if self.config.COPYIN_MODE == "bundle":
+                graph.add("bundle", self.prepareBundle,
+                          ["image"] if self.config.BAKE_FILES and "image" in graph.phases else [])
+                ready = ready + ["bundle"]
+            graph.add("copyin", copyIn, ready)
+            graph.add("runjob", runJob, ["copyin"])
+            graph.add("copyout", copyOut, ["runjob"])
+            graph.add("resources", self.pullResourceUsage, ["runjob"])
+            try:
+                graph.run()
+            finally:
+                graph.logCriticalPath()
 
             # handle failure(s) of runjob and/or copyout.  runjob error takes priority.
             if ret["runjob"] != 0:
@@ -539,7 +3011,7 @@ class Grader():
                     msg = "Error: Autodriver usage error"
                 elif ret["runjob"] == -1 or ret["runjob"] == 2:  # both are timeouts
                     msg = "Error: Job timed out. timeout setting: %d seconds" % (
-                        config.WAITVM_TIMEOUT)
+                        self.config.WAITVM_TIMEOUT)
                 elif ret["runjob"] == 3:  # EXIT_OSERROR in Autodriver
                     msg = "Error: OS error while running job on VM"
                 else:  # This should never happen
@@ -549,14 +3021,495 @@ class Grader():
                 msg += "Error: Copy out from VM failed (status=%d)" % (ret["copyout"])
             else:
                 msg = "Success: Autodriver returned normally"
+                if resultKey and os.path.exists(self.tmpOutput):
+                    resultCache.store(resultKey, self.tmpOutput,
+                                      {"submission_id": self.config.SUBMISSION_ID,
+                                       "time": time.time()})
 
             self.afterJob(msg)
 
+        except SystemExit:
+            # a step failed with exit().  The vm goes now, as the exit
+            # handler only sees the graders still active
+            msg = "Error: job failed in phase %s" % (graph.failedPhase if graph and graph.failedPhase
+                                                     else "setup")
+            t = time.time()
+            self.destroyVM(notes="destroyVM initiated by a failed step")
+            self.recordPhase("destroy", t)
+            raise
         except Exception as err:
             self.appendMsg("exception %s" % err)
             self.afterJob(msg)
+        finally:
+            # a job ending with exit() still leaves what it has written,
+            # and its metrics, as far as it got
+            self.outputFile.finish()
+            if not self.metricsWritten:
+                self.writeMetrics(msg or "Error: job failed")
+            with activeGradersLock:
+                activeGraders.discard(self)
     # end of Grader.run()
 # end of class Grader
 
-atexit.register(exitHandler)
-Grader().run()
+# Packs the jobs of the grading service onto shared, larger vms of
+# PACK_INST_TYPE.  A vm (host) has up to PACK_MAX_SLOTS job slots, and a job
+# takes the lowest free slot on the first host with enough vcpus and memory
+# left for its JOB_CPUS and JOB_MEMORY_MB hints.  When no host has room, a
+# new one is launched, and the jobs arriving meanwhile are packed onto it
+# too.  Slot N is graded by user <PACK_USER_PREFIX>N in directory slotN/ of
+# the ssh user, so slots never see each other's files or processes.  A host
+# is terminated when it has been empty for PACK_IDLE_TIMEOUT seconds.
+class VMPacker():
+    # memory (MiB) of a host kept for the system
+    _SYSTEM_MEMORY_MB = 512
+
+    def __init__(self, config, prober):
+        self.config = config
+        self.prober = prober
+        self.cloud = Ec2(config)
+        self.cloud.findImage()
+        self.cloud.secGroup = "secGroup_pack_%s_%s" % (config.IMAGE_TAG,
+                                                       time.strftime("%Y-%m-%dT%H-%M-%S",
+                                                                     time.localtime()))
+        self.cond = threading.Condition()
+        self.hosts = []
+        self.hostCount = 0
+
+        self.log = logging.getLogger("GraderPacker")
+        self.log.setLevel(logging.DEBUG)
+
+        info = self.cloud.boto3client.describe_instance_types(
+            InstanceTypes=[config.PACK_INST_TYPE])["InstanceTypes"][0]
+        self.cpus = info["VCpuInfo"]["DefaultVCpus"]
+        self.memoryMB = max(info["MemoryInfo"]["SizeInMiB"] - self._SYSTEM_MEMORY_MB, 0)
+        self.log.info("packing on %s: %d vcpus, %d MiB, up to %d slots" %
+                      (config.PACK_INST_TYPE, self.cpus, self.memoryMB, config.PACK_MAX_SLOTS))
+
+    # Block until a slot is ready for a job with the given hints.  Return
+    # the host and the slot number.  Raise if the host fails to launch.
+    def acquire(self, cpus, memoryMB):
+        # a job asking for more than a host has gets a host of its own
+        cpus = min(cpus, self.cpus)
+        memoryMB = min(memoryMB, self.memoryMB)
+        with self.cond:
+            for host in self.hosts:
+                if host.error is None and not host.retiring and \
+                   len(host.slots) < self.config.PACK_MAX_SLOTS and \
+                   host.cpus >= cpus and host.memoryMB >= memoryMB:
+                    break
+            else:
+                self.hostCount += 1
+                vm = VM(image_tag=self.config.IMAGE_TAG, instance_type=self.config.PACK_INST_TYPE,
+                        name="pack_%s_%s_%d" % (self.config.IMAGE_TAG,
+                                                time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime()),
+                                                self.hostCount))
+                host = types.SimpleNamespace(vm=vm, slots={}, cpus=self.cpus,
+                                             memoryMB=self.memoryMB, ready=False,
+                                             error=None, retiring=False, idleTimer=None)
+                self.hosts.append(host)
+                threading.Thread(target=self.launch, args=(host,), daemon=True).start()
+
+            slot = min(set(range(1, self.config.PACK_MAX_SLOTS + 1)) - set(host.slots))
+            host.slots[slot] = (cpus, memoryMB)
+            host.cpus -= cpus
+            host.memoryMB -= memoryMB
+            if host.idleTimer:
+                host.idleTimer.cancel()
+                host.idleTimer = None
+            self.log.info("slot %d of %s taken, %d jobs on it" % (slot, host.vm.name, len(host.slots)))
+
+            while not host.ready and host.error is None:
+                self.cond.wait()
+            if host.error is not None:
+                self.releaseLocked(host, slot)
+                raise host.error
+        return host, slot
+
+    def launch(self, host):
+        start_time = time.time()
+        try:
+            self.cloud.createVM(host.vm)
+            if not self.prober.probeVM(host.vm):
+                raise ValueError("%s not ready after %d seconds" %
+                                 (host.vm, self.config.WAITVM_TIMEOUT))
+            self.log.info("launched %s %s in %.1f seconds" %
+                          (host.vm.name, host.vm, time.time() - start_time))
+        except Exception as e:
+            self.log.error("failed to launch %s: %s" % (host.vm.name, e))
+            if host.vm.instance_id:
+                self.terminate(host)
+            with self.cond:
+                host.error = e
+                if host in self.hosts:
+                    self.hosts.remove(host)
+                self.cond.notify_all()
+            return
+        with self.cond:
+            host.ready = True
+            self.cond.notify_all()
+            retiring = host.retiring
+        if retiring:  # the service has stopped meanwhile
+            self.terminate(host)
+
+    def release(self, host, slot):
+        with self.cond:
+            self.releaseLocked(host, slot)
+
+    # ids of the live hosts, see Reaper.sweep()
+    def hostIds(self):
+        with self.cond:
+            return {host.vm.instance_id for host in self.hosts if host.vm.instance_id}
+
+    def releaseLocked(self, host, slot):
+        if slot not in host.slots:
+            return
+        cpus, memoryMB = host.slots.pop(slot)
+        host.cpus += cpus
+        host.memoryMB += memoryMB
+        self.log.info("slot %d of %s freed, %d jobs on it" % (slot, host.vm.name, len(host.slots)))
+        if not host.slots and host.ready:
+            host.idleTimer = threading.Timer(self.config.PACK_IDLE_TIMEOUT, self.retire, args=(host,))
+            host.idleTimer.daemon = True
+            host.idleTimer.start()
+
+    # terminate the host if it's still empty
+    def retire(self, host):
+        with self.cond:
+            if host.slots or host.retiring:
+                return
+            host.retiring = True
+            self.hosts.remove(host)
+        self.log.info("%s idle for %ds" % (host.vm.name, self.config.PACK_IDLE_TIMEOUT))
+        self.terminate(host)
+
+    def terminate(self, host):
+        try:
+            self.cloud.terminateVM(host.vm)
+        except Exception as e:
+            self.log.error("failed to terminate %s: %s" % (host.vm, e))
+
+    # terminate all hosts, when the service stops
+    def drain(self):
+        with self.cond:
+            hosts = [h for h in self.hosts if not h.retiring]
+            for host in hosts:
+                host.retiring = True
+                if host.idleTimer:
+                    host.idleTimer.cancel()
+            self.hosts = []
+        for host in hosts:
+            if host.vm.instance_id:
+                self.terminate(host)
+        self.cloud.deleteSecurityGroup()
+# end of class VMPacker
+
+# Bakes the large input files of an assignment into an image ("grader.py
+# --bake" in a job directory whose config.yaml names them in BAKE_FILES
+# and lists them in inputFiles), so that the jobs don't copy them in.
+#
+# A builder vm is launched once from the IMAGE_TAG image, gets the files in
+# BAKE_DIR and is saved as a new image, tagged <IMAGE_TAG>-baked-<key>.  The
+# key is a hash of the base image id and the files' names and content, so
+# a changed grader file or base image gets a new image and the old one is
+# simply no longer found.  A job whose BAKE_FILES hash to an existing image
+# launches its vm from it and copies the files from BAKE_DIR into its
+# input directory on the vm, see Ec2.findImage() and Grader.findImage().
+# Old baked images are not deregistered.
+class ImageBaker():
+    # seconds between the checks of the new image's state
+    _POLL_INTERVAL = 15
+
+    def __init__(self, config, cloud, grader):
+        self.config = config
+        self.cloud = cloud
+        self.grader = grader
+        self.log = logging.getLogger("ImageBaker")
+        self.log.setLevel(logging.DEBUG)
+
+    # name tag of the image baked from image baseId with bakeFiles, [local
+    # path, dest] pairs
+    @staticmethod
+    def imageTag(config, baseId, bakeFiles):
+        h = hashlib.sha256()
+        h.update(json.dumps({"image": baseId,
+                             "files": sorted([dest, fileHash(src)] for src, dest in bakeFiles)},
+                            sort_keys=True).encode())
+        return "%s-baked-%s" % (config.IMAGE_TAG, h.hexdigest()[:16])
+
+    # Bake bakeFiles into a new image made from the builder vm, which is
+    # destroyed at the end.  Return the new image's id.  Simply exit on error.
+    def bake(self, bakeFiles):
+        startTime = time.strftime("%Y-%m-%dT%H-%M-%S", time.localtime())
+        tag = ImageBaker.imageTag(self.config, self.cloud.imageId, bakeFiles)
+        vm = VM(image_tag=self.config.IMAGE_TAG, instance_type=self.config.EC2_INST_TYPE,
+                name="bake_%s_%s" % (self.config.IMAGE_TAG, startTime))
+        self.cloud.secGroup = "secGroup_bake_%s_%s" % (self.config.IMAGE_TAG, startTime)
+        self.grader.vm = vm
+        self.grader.inputFiles = bakeFiles
+        try:
+            self.cloud.initializeVM(vm)
+            self.grader.waitVM(vm)
+
+            bakeDir = shlex.quote(self.config.BAKE_DIR)
+            compression = self.grader.bundleCompression()
+            remoteCmd = "rm -rf {0}; mkdir -p {0} && {1} && sync".format(
+                bakeDir, self.grader.unpackCmd(compression, bakeDir))
+            ret, wireBytes = self.grader.sendBundle(bakeFiles, remoteCmd, compression)
+            if ret != 0:
+                self.log.error("failed to copy the files to builder vm %s. return code %s" % (vm, ret))
+                exit(-1)
+            self.log.info("copied %d files as %d bytes to builder vm %s" %
+                          (len(bakeFiles), wireBytes, vm))
+
+            # AMI names are unique, the name tag is what jobs look for
+            response = self.cloud.boto3client.create_image(
+                InstanceId=vm.instance_id,
+                Name="%s-%s" % (tag, startTime),
+                Description="%s with %s" % (self.cloud.imageId,
+                                            ", ".join(pair[1] for pair in bakeFiles)),
+                TagSpecifications=[{"ResourceType": "image",
+                                    "Tags": [{"Key": "Name", "Value": tag},
+                                             {"Key": "grader:base-image", "Value": self.cloud.imageId}]}])
+            imageId = response["ImageId"]
+            self.log.info("creating image %s with name tag %s from vm %s" % (imageId, tag, vm))
+            start_time = time.time()
+            self.cloud.boto3client.get_waiter("image_available").wait(
+                ImageIds=[imageId],
+                WaiterConfig={"Delay": self._POLL_INTERVAL,
+                              "MaxAttempts": max(1, self.config.BAKE_TIMEOUT // self._POLL_INTERVAL)})
+            self.log.info("image %s is available after %.1f seconds" % (imageId, time.time() - start_time))
+        except SystemExit:
+            raise
+        except Exception as e:
+            self.log.error("failed to bake image %s: %s" % (tag, e))
+            exit(-1)
+        finally:
+            self.grader.closeMaster(vm)
+            self.cloud.destroyVM(vm, notes="builder vm of image %s" % tag)
+
+        # the jobs of this host find the new image without asking EC2
+        if self.config.IMAGE_CACHE_TTL > 0:
+            key = "%s/%s" % (self.config.EC2_REGION, tag)
+            entry = {"id": imageId, "time": time.time()}
+            with Ec2._lock:
+                Ec2._images[key] = entry
+            self.cloud.updateImageCache(key, entry)
+        return imageId
+
+    @staticmethod
+    def main():
+        grader = Grader(forJob=False)
+        log = logging.getLogger("ImageBaker")
+        names = set(config.BAKE_FILES)
+        bakeFiles = [[os.path.join(config.passedInDir, f["src"]), f["dest"]]
+                     for f in config.inputFiles or [] if f["dest"] in names]
+        missing = names - set(pair[1] for pair in bakeFiles)
+        if not bakeFiles or missing:
+            log.error("BAKE_FILES %s are not all in inputFiles (missing %s)" %
+                      (config.BAKE_FILES, sorted(missing)))
+            exit(-1)
+
+        cloud = Ec2(config)
+        grader.cloudConnector = cloud
+        cloud.findImage(bakeFiles)
+        if cloud.baked:
+            log.info("image %s with name tag %s is up to date" % (cloud.imageId, cloud.imageTag))
+            return
+        imageId = ImageBaker(config, cloud, grader).bake(bakeFiles)
+        log.info("baked image %s with %s" % (imageId, ", ".join(sorted(names))))
+# end of class ImageBaker
+
+# Long-lived grading service ("grader.py --serve SPOOL_DIR") which runs many
+# jobs in one process, so that they share the boto3 clients, the image
+# lookup, the instance state polling and the Python start-up cost.
+#
+# A job is submitted by renaming its complete directory (config.yaml plus
+# input files, as the standalone grader's passedInDir) into
+# <SPOOL_DIR>/incoming/.  The service moves it to running/, grades it and
+# then moves it to done/ with output and grader.log inside.  The service's
+# own config is <SPOOL_DIR>/config.yaml, which each job's config.yaml
+# overrides, and it logs to <SPOOL_DIR>/service.log.
+class GradingService():
+    def __init__(self, spoolDir):
+        self.spoolDir = os.path.abspath(spoolDir)
+        self.dirs = {}
+        for d in ("incoming", "running", "done"):
+            self.dirs[d] = os.path.join(self.spoolDir, d)
+            os.makedirs(self.dirs[d], exist_ok=True)
+        self.serviceConfig = os.path.join(self.spoolDir, "config.yaml")
+
+        global config
+        config, error = loadConfig(self.spoolDir, forJob=False)
+
+        # set timezone for logging
+        os.environ["TZ"] = config.TIMEZONE
+        time.tzset()
+
+        logging.basicConfig(
+            filename=os.path.join(self.spoolDir, "service.log"),
+            format="%(levelname)s|%(name)s|%(asctime)s|%(message)s")
+        self.log = logging.getLogger("GradingService")
+        self.log.setLevel(logging.DEBUG)
+        for e in error:
+            self.log.error(e)
+        if error:
+            exit(-1)
+
+        # jobs share larger vms, see VMPacker
+        self.packer = None
+        if config.PACK_INST_TYPE:
+            prober = Grader(self.spoolDir, forJob=False, jobName="packer")
+            self.packer = VMPacker(config, prober)
+
+        # the jobs' vms are terminated by an in-process reaper
+        self.reaper = None
+        if config.REAPER_DIR:
+            self.reaper = Reaper(config, Ec2.sharedClient(config), self.packer)
+            threading.Thread(target=self.reaper.manage, name="reaper", daemon=True).start()
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.jobCount = 0
+        # worker slots taken by the running jobs.  A job logs under its
+        # slot's logger, so that the loggers don't pile up.
+        self.workerSlots = set()
+        self.finishTimes = []  # finish time of each job, for throughput
+        self.stopping = False
+
+    # Grade the job in directory jobDir of running/ in worker slot
+    # workerSlot, then move it to done/.
+    # Never raises: a failing job must not take the service down.
+    def runJob(self, jobName, jobDir, workerSlot):
+        start_time = time.time()
+        grader = None
+        try:
+            grader = Grader(jobDir, baseConfigFiles=[self.serviceConfig],
+                            jobName="worker-%d" % workerSlot, packer=self.packer)
+            grader.run()
+        except BaseException as e:  # exit() in a job raises SystemExit
+            self.log.error("%s: job ended with %r" % (jobName, e))
+        finally:
+            if grader:
+                grader.destroyVM(notes="destroyVM initiated by grading service")
+                grader.closeLog()
+            try:
+                os.rename(jobDir, os.path.join(self.dirs["done"], os.path.basename(jobDir)))
+            except OSError as e:
+                self.log.error("%s: failed to move %s to done: %s" % (jobName, jobDir, e))
+
+            now = time.time()
+            with self.lock:
+                self.running -= 1
+                self.workerSlots.discard(workerSlot)
+                self.finishTimes.append(now)
+                window = [t for t in self.finishTimes
+                          if t > now - config.SERVICE_THROUGHPUT_WINDOW]
+                self.finishTimes = window
+                running = self.running
+            self.log.info("%s: done in %.2fs. %.1f jobs/minute over the last %ds, "
+                          "%d running (concurrency %d)" %
+                          (jobName, now - start_time,
+                           len(window) * 60.0 / config.SERVICE_THROUGHPUT_WINDOW,
+                           config.SERVICE_THROUGHPUT_WINDOW, running,
+                           config.SERVICE_CONCURRENCY))
+
+    # Move new jobs from incoming/ to running/ and start them, as long as
+    # fewer than SERVICE_CONCURRENCY jobs are running.
+    def dispatch(self):
+        for name in sorted(os.listdir(self.dirs["incoming"])):
+            with self.lock:
+                if self.running >= config.SERVICE_CONCURRENCY:
+                    return
+            src = os.path.join(self.dirs["incoming"], name)
+            if not os.path.isdir(src):
+                continue
+            dest = os.path.join(self.dirs["running"], name)
+            if os.path.exists(dest):
+                self.log.error("job %s is already running. leave it in incoming" % name)
+                continue
+            os.rename(src, dest)
+
+            with self.lock:
+                self.running += 1
+                self.jobCount += 1
+                jobName = "job-%d" % self.jobCount
+                workerSlot = min(set(range(1, config.SERVICE_CONCURRENCY + 1)) - self.workerSlots)
+                self.workerSlots.add(workerSlot)
+            self.log.info("%s: start %s in worker %d" % (jobName, dest, workerSlot))
+            threading.Thread(target=self.runJob, args=(jobName, dest, workerSlot),
+                             name=jobName, daemon=True).start()
+
+    # Jobs left in running/ by a service which died can't be resumed.
+    # Move them back to incoming/ so that they are graded again.
+    def recover(self):
+        for name in os.listdir(self.dirs["running"]):
+            self.log.warning("requeue job %s left by previous service" % name)
+            os.rename(os.path.join(self.dirs["running"], name),
+                      os.path.join(self.dirs["incoming"], name))
+
+    def serve(self):
+        self.log.info("serving %s with concurrency %d" %
+                      (self.spoolDir, config.SERVICE_CONCURRENCY))
+        self.recover()
+        try:
+            while not self.stopping:
+                self.dispatch()
+                time.sleep(config.SERVICE_POLL_INTERVAL)
+        finally:
+            self.drain()
+
+    # Stop taking new jobs and wait for the running ones to finish
+    def drain(self):
+        self.stopping = True
+        self.log.info("draining: waiting for %d running jobs" % self.running)
+        while True:
+            with self.lock:
+                if self.running == 0:
+                    break
+            time.sleep(config.SERVICE_POLL_INTERVAL)
+        if self.packer:
+            self.packer.drain()
+        if self.reaper:
+            self.reaper.reap()
+        self.log.info("drained")
+
+    @staticmethod
+    def main(spoolDir):
+        service = GradingService(spoolDir)
+
+        # turn "docker stop" into a normal exit so the running jobs finish
+        def stop(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, stop)
+
+        service.serve()
+# end of class GradingService
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an Autolab job on a cloud VM")
+    parser.add_argument("--pool", action="store_true",
+                        help="run as the manager of the warm vm pool in VM_POOL_DIR")
+    parser.add_argument("--reap", action="store_true",
+                        help="run as the terminator of the vms handed off to REAPER_DIR")
+    parser.add_argument("--metrics", action="store_true",
+                        help="aggregate the jobs' metrics in METRICS_DIR into grader.prom")
+    parser.add_argument("--serve", metavar="SPOOL_DIR",
+                        help="run as a long-lived service grading the jobs submitted to SPOOL_DIR")
+    parser.add_argument("--bake", action="store_true",
+                        help="bake the job's BAKE_FILES into an image for the jobs to launch from")
+    args = parser.parse_args()
+
+    if args.pool:
+        VMPool.main()
+    elif args.reap:
+        Reaper.main()
+    elif args.metrics:
+        MetricsReport.main()
+    elif args.serve:
+        atexit.register(exitHandler)
+        GradingService.main(args.serve)
+    elif args.bake:
+        ImageBaker.main()
+    else:
+        atexit.register(exitHandler)
+        Grader().run()